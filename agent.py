@@ -1,14 +1,35 @@
 import os
+import asyncio
+import binascii
+import hashlib
+import html.parser
+import quopri
 import smtplib
 import imaplib
 import email
+import json
+import random
+import re
+import sqlite3
 import time
 import logging
 import sys
+import select
+import socket
+import queue
+import contextlib
+import multiprocessing
+import threading
+import urllib.parse
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
 from email.message import EmailMessage
 from email.header import decode_header
-from email.utils import parseaddr
+from email.utils import make_msgid, parseaddr
 
+import numpy as np
 import google.generativeai as genai
 
 # --- Konfiguracja ---
@@ -18,12 +39,16 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     stream=sys.stdout)
 
+# Plik JSON z listą kont i folderów - wiele skrzynek obsługiwanych przez jeden proces.
+# Bez niego agent obsługuje tylko folder "inbox" konta EMAIL_ADDRESS.
+ACCOUNTS_FILE = os.environ.get("ACCOUNTS_FILE")
+
 # Wczytaj dane logowania i klucz API ze zmiennych środowiskowych
 # Ustawisz je w panelu Render w zakładce "Environment"
 try:
     GEMINI_API_KEY = os.environ['GEMINI_API_KEY']
-    EMAIL_ADDRESS = os.environ['EMAIL_ADDRESS']
-    EMAIL_PASSWORD = os.environ['EMAIL_PASSWORD']
+    EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS', "") if ACCOUNTS_FILE else os.environ['EMAIL_ADDRESS']
+    EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', "") if ACCOUNTS_FILE else os.environ['EMAIL_PASSWORD']
 except KeyError as e:
     logging.fatal(f"BŁĄD: Brak kluczowej zmiennej środowiskowej: {e}")
     logging.fatal("Upewnij się, że GEMINI_API_KEY, EMAIL_ADDRESS, i EMAIL_PASSWORD są ustawione w Render.")
@@ -34,38 +59,804 @@ IMAP_SERVER = "imap.gmail.com"
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 465  # Port SSL dla SMTP
 
-# Jak często sprawdzać nowe maile (w sekundach)
-CHECK_INTERVAL_SEC = 60
+# Pula połączeń SMTP: ile sesji naraz, po ilu mailach / sekundach je odnawiać
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "2"))
+SMTP_MAX_MESSAGES = 100
+SMTP_MAX_AGE_SEC = 10 * 60
+# Po jakim czasie bezczynności sprawdzamy połączenie komendą NOOP
+SMTP_NOOP_AFTER_SEC = 30
+# Limit czasu operacji na gnieździe SMTP - zawieszony serwer nie blokuje wysyłki w nieskończoność
+SMTP_TIMEOUT_SEC = int(os.environ.get("SMTP_TIMEOUT_SEC", "60"))
+
+# Model Gemini używany do odpowiedzi
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-pro")
+# Co ile sekund bezczynności "rozgrzewać" połączenie z Gemini (0 = wyłączone)
+GEMINI_KEEPALIVE_SEC = int(os.environ.get("GEMINI_KEEPALIVE_SEC", "240"))
+
+# Limity zapytań do Gemini po stronie klienta: "model=RPM:TPM,model2=RPM:TPM"
+# (zapytania i tokeny na minutę); modele spoza listy dostają limity domyślne
+GEMINI_RATE_LIMITS = os.environ.get("GEMINI_RATE_LIMITS", "")
+GEMINI_DEFAULT_RPM = int(os.environ.get("GEMINI_DEFAULT_RPM", "60"))
+GEMINI_DEFAULT_TPM = int(os.environ.get("GEMINI_DEFAULT_TPM", "120000"))
+# Zakładana długość odpowiedzi (w tokenach) przy rezerwowaniu limitu przed zapytaniem
+GEMINI_EXPECTED_OUTPUT_TOKENS = 500
+
+# Ponawianie zapytań do Gemini: liczba prób, opóźnienia i łączny limit czasu zapytania
+GEMINI_MAX_ATTEMPTS = int(os.environ.get("GEMINI_MAX_ATTEMPTS", "5"))
+GEMINI_RETRY_BASE_SEC = 1
+GEMINI_RETRY_MAX_SEC = 30
+GEMINI_DEADLINE_SEC = int(os.environ.get("GEMINI_DEADLINE_SEC", "120"))
+# Minimalny czas na samo zapytanie - gdy kolejka limitu zostawia mniej, mail jest odkładany
+GEMINI_MIN_CALL_SEC = 10
+# Bezpiecznik: po tylu kolejnych błędach przestajemy pytać Gemini (i pobierać maile)
+GEMINI_BREAKER_THRESHOLD = 5
+GEMINI_BREAKER_RESET_SEC = 60
+
+# Generowanie strumieniowe (stream=True): odpowiedź zbierana kawałkami, z limitem
+# długości i czasu - po przekroczeniu strumień jest przerywany
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "0") == "1"
+GEMINI_MAX_ANSWER_CHARS = int(os.environ.get("GEMINI_MAX_ANSWER_CHARS", "20000"))
+GEMINI_GENERATION_BUDGET_SEC = int(os.environ.get("GEMINI_GENERATION_BUDGET_SEC", "90"))
+
+# Limit długości promptu (w tokenach) - dłuższa treść jest przycinana
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "4000"))
+# Usuwanie cytowanej historii, podpisów i stopek przed wysłaniem do Gemini
+PROMPT_STRIP_QUOTES = os.environ.get("PROMPT_STRIP_QUOTES", "1") == "1"
+# Maile bez części text/plain: limit długości tekstu wyciągniętego z HTML (w znakach)
+HTML_TEXT_MAX_CHARS = int(os.environ.get("HTML_TEXT_MAX_CHARS", "16000"))
+
+# Historia rozmów: odpowiedź na naszą odpowiedź idzie do Gemini jako rozmowa wieloturowa
+CONVERSATION_ENABLED = os.environ.get("CONVERSATION_ENABLED", "1") == "1"
+# Ile tokenów wcześniejszych tur dołączamy do pytania (starsze są pomijane)
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", "3000"))
+# Wątki nieaktywne dłużej niż tyle dni są usuwane z bazy
+CONVERSATION_TTL_SEC = int(os.environ.get("CONVERSATION_TTL_DAYS", "30")) * 24 * 3600
+
+# Rejestr przetworzonych maili - po awarii nie odpowiadamy (i nie płacimy za Gemini) drugi raz
+LEDGER_ENABLED = os.environ.get("LEDGER_ENABLED", "1") == "1"
+# Filtr Blooma przed bazą: przewidywana liczba wpisów i dopuszczalny odsetek fałszywych trafień
+LEDGER_BLOOM_CAPACITY = int(os.environ.get("LEDGER_BLOOM_CAPACITY", "2000000"))
+LEDGER_BLOOM_ERROR_RATE = 0.001
+# Po ilu dniach zapominamy o w pełni obsłużonych mailach
+LEDGER_TTL_SEC = int(os.environ.get("LEDGER_TTL_DAYS", "90")) * 24 * 3600
+
+# Bufor odpowiedzi dla powtarzających się promptów
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MEMORY_ITEMS = 1000
+RESPONSE_CACHE_MAX_ITEMS = int(os.environ.get("RESPONSE_CACHE_MAX_ITEMS", "50000"))
+RESPONSE_CACHE_TTL_SEC = int(os.environ.get("RESPONSE_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+# Nadawcy (adresy rozdzielone przecinkami), którym zawsze generujemy świeżą odpowiedź
+RESPONSE_CACHE_OPTOUT = {a.strip().lower() for a in os.environ.get("RESPONSE_CACHE_OPTOUT", "").split(",") if a.strip()}
+
+# Drugi poziom bufora: podobne (sparafrazowane) prompty, porównywane przez embeddingi
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+# Minimalne podobieństwo kosinusowe, przy którym uznajemy prompt za ten sam
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_CAPACITY = int(os.environ.get("SEMANTIC_CACHE_CAPACITY", "20000"))
+# Lokalny model sentence-transformers (np. "all-MiniLM-L6-v2"); bez niego bufor semantyczny jest wyłączony
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", "")
+
+# Co ile sekund wypisywać do logów liczniki (metryki) agenta
+METRICS_LOG_INTERVAL_SEC = 300
+
+# Jak często sprawdzać nowe maile (w sekundach) - punkt wyjścia adaptacyjnego odpytywania
+CHECK_INTERVAL_SEC = int(os.environ.get("CHECK_INTERVAL_SEC", "60"))
+# Gdy maile napływają, sprawdzamy co POLL_MIN_INTERVAL_SEC; w ciszy odstęp rośnie
+# wykładniczo (x POLL_BACKOFF_FACTOR) do POLL_MAX_INTERVAL_SEC
+POLL_MIN_INTERVAL_SEC = int(os.environ.get("POLL_MIN_INTERVAL_SEC", "5"))
+POLL_MAX_INTERVAL_SEC = int(os.environ.get("POLL_MAX_INTERVAL_SEC", "900"))
+POLL_BACKOFF_FACTOR = 2.0
+# Losowy rozrzut odstępu (+/- 20%), by wiele agentów nie odpytywało serwera jednocześnie
+POLL_JITTER = 0.2
+
+# Tryb IMAP IDLE (push) - serwer sam informuje o nowych mailach
+USE_IDLE = os.environ.get("USE_IDLE", "1") == "1"
+# Gmail zrywa IDLE po ~29 minutach, więc odnawiamy je wcześniej
+IDLE_TIMEOUT_SEC = 25 * 60
+
+# Sesja IMAP: po jakim czasie bezczynności sprawdzamy połączenie komendą NOOP
+IMAP_NOOP_AFTER_SEC = 60
+# Limit czasu operacji na gnieździe IMAP (IDLE czeka osobno, przez select)
+IMAP_TIMEOUT_SEC = int(os.environ.get("IMAP_TIMEOUT_SEC", "120"))
+# Ponowne łączenie: wykładnicze opóźnienie od 1 s do 5 minut
+IMAP_RECONNECT_MIN_SEC = 1
+IMAP_RECONNECT_MAX_SEC = 300
+
+# Tryb synchronizacji: "uid" - przyrostowo po UID z zapisanym punktem kontrolnym,
+# "unseen" - stare zachowanie (wyszukiwanie nieprzeczytanych)
+SYNC_MODE = os.environ.get("SYNC_MODE", "uid")
+# Katalog na lokalny stan agenta (punkty kontrolne synchronizacji itp.)
+STATE_DIR = os.environ.get("STATE_DIR", ".agent_state")
+# Ile wiadomości pobierać jedną komendą UID FETCH
+FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "50"))
+
+# Trwała skrzynka nadawcza: odpowiedzi czekają tu, aż serwer SMTP je przyjmie
+OUTBOX_FLUSH_INTERVAL_SEC = 10
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_RETRY_BASE_SEC = 5
+OUTBOX_RETRY_MAX_SEC = 30 * 60
+OUTBOX_MAX_ATTEMPTS = 20
+# Na tyle sekund wiadomość jest "zarezerwowana" dla wątku, który ją właśnie wysyła
+OUTBOX_CLAIM_SEC = 120
+# Nagłówki pobierane w pierwszym, tanim przebiegu (zamiast całego RFC822)
+FETCH_HEADER_FIELDS = "FROM SUBJECT MESSAGE-ID IN-REPLY-TO REFERENCES AUTO-SUBMITTED PRECEDENCE LIST-ID"
+# Wiadomości większe niż ten limit (RFC822.SIZE) pomijamy bez pobierania treści
+MAX_MESSAGE_SIZE = int(os.environ.get("MAX_MESSAGE_SIZE", str(25 * 1024 * 1024)))
+# Parsowanie całych wiadomości w osobnych procesach (0 = w procesie agenta, jak dawniej)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0"))
+# Mniejsze wiadomości parsujemy na miejscu - przesłanie do procesu kosztuje więcej niż parsowanie
+PARSE_POOL_MIN_BYTES = 64 * 1024
+# Większe przekazujemy przez pamięć współdzieloną zamiast przez potok (pickle)
+PARSE_SHM_MIN_BYTES = 1024 * 1024
+# Maksymalny czas parsowania jednej wiadomości w procesie roboczym
+PARSE_TIMEOUT_SEC = 60
+# Wiadomości od tego rozmiaru pobieramy kawałkami i parsujemy strumieniowo (bez drzewa MIME)
+STREAM_PARSE_MIN_BYTES = int(os.environ.get("STREAM_PARSE_MIN_BYTES", str(1024 * 1024)))
+STREAM_FETCH_CHUNK_BYTES = 256 * 1024
+# Limity pamięci parsera strumieniowego: nagłówki jednej części i zebrana treść
+STREAM_HEADER_MAX_BYTES = 64 * 1024
+STREAM_TEXT_MAX_BYTES = 1024 * 1024
+
+# Potok przetwarzania: liczba równoległych wątków Gemini (0 = po kolei, jak dawniej)
+LLM_WORKERS = int(os.environ.get("LLM_WORKERS", "4"))
+# Pojemność kolejek między etapami - gdy są pełne, pobieranie z IMAP czeka
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "20"))
+# Ile razy próbujemy odpowiedzieć na maila, którego odpowiedź nie dała się wysłać
+SEND_MAX_ATTEMPTS = 3
+# Jak często (w sekundach) budzić IDLE, by zatwierdzić maile obsłużone w tle
+PIPELINE_COMMIT_INTERVAL_SEC = 5
+
+# Silnik: "threads" (potok na wątkach) albo "async" (jedna pętla asyncio dla Gemini)
+ENGINE = os.environ.get("ENGINE", "threads")
+# Ile zapytań do Gemini może jednocześnie czekać na odpowiedź w silniku async
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get("ASYNC_MAX_IN_FLIGHT", "200"))
+
+# Wiele replik agenta na jednej skrzynce: "none" (jedna replika), "modulo" (replika
+# obsługuje UID % WORKER_COUNT == WORKER_INDEX) albo "claim" (przed obsługą mail jest
+# rezerwowany słowem kluczowym IMAP; rezerwacje padniętych replik wygasają)
+COORDINATION = os.environ.get("COORDINATION", "none")
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+# Identyfikator repliki w słowach kluczowych (tylko znaki dozwolone w atomie IMAP)
+WORKER_ID = re.sub(r"[^A-Za-z0-9-]", "-", os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}"))
+CLAIM_KEYWORD_PREFIX = "$AgentClaimed_"
+# Po tylu sekundach rezerwacja wygasa i mail może przejąć inna replika
+CLAIM_TIMEOUT_SEC = int(os.environ.get("CLAIM_TIMEOUT_SEC", "600"))
+# Co ile sekund szukamy nieprzeczytanych maili z wygasłą rezerwacją
+CLAIM_RECLAIM_INTERVAL_SEC = 300
+# Rezerwację maila, który wciąż obsługujemy (kolejka, odłożony), odnawiamy po tylu sekundach
+CLAIM_RENEW_AFTER_SEC = CLAIM_TIMEOUT_SEC // 2
+
+# --- Metryki ---
+
+class Metrics:
+    """Proste, bezpieczne wątkowo liczniki i wskaźniki wypisywane okresowo do logów."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def observe(self, name, value):
+        """Rejestruje pomiar (np. czas): liczba, suma i maksimum."""
+        with self._lock:
+            self._values[f"{name}.count"] = self._values.get(f"{name}.count", 0) + 1
+            self._values[f"{name}.sum"] = round(self._values.get(f"{name}.sum", 0) + value, 3)
+            self._values[f"{name}.max"] = round(max(self._values.get(f"{name}.max", 0), value), 3)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def start_logging(self):
+        """Uruchamia wątek, który co METRICS_LOG_INTERVAL_SEC wypisuje metryki."""
+        def reporter():
+            while True:
+                time.sleep(METRICS_LOG_INTERVAL_SEC)
+                values = self.snapshot()
+                if values:
+                    logging.info("Metryki: " + ", ".join(f"{k}={v}" for k, v in sorted(values.items())))
+        threading.Thread(target=reporter, name="metrics", daemon=True).start()
+
+metrics = Metrics()
 
 # --- Logika Gemini ---
 
-def get_gemini_response(prompt):
-    """Wysyła prompt do Gemini i zwraca odpowiedź."""
+# Odpowiedź wysyłana, gdy Gemini zablokuje odpowiedź (nie trafia do bufora)
+BLOCKED_ANSWER = "Niestety, nie mogę wygenerować odpowiedzi na ten temat (odpowiedź zablokowana)."
+
+def _response_text(response):
+    """Wyciąga tekst z odpowiedzi Gemini (wspólne dla wersji sync i async)."""
+    # Sprawdzenie, czy odpowiedź nie została zablokowana
+    if not response.parts:
+        logging.warning("Odpowiedź Gemini była pusta lub zablokowana (safety reasons).")
+        return BLOCKED_ANSWER
+
+    return response.text
+
+class GeminiClient:
+    """Konfiguruje SDK Gemini raz i trzyma gotowe uchwyty modeli.
+
+    Modele są zapamiętywane według nazwy i konfiguracji generowania, więc
+    kolejne zapytania korzystają z tego samego klienta i jego połączeń.
+    Bezpieczne dla wielu wątków i korutyn (blokada nie obejmuje żadnego await).
+    """
+
+    def __init__(self, api_key=GEMINI_API_KEY):
+        self.api_key = api_key
+        self._configured = False
+        self._models = {}
+        self._lock = threading.Lock()
+        self.last_used = 0.0
+        self._keepalive_task = None  # referencja, aby zadanie nie zostało usunięte przez GC
+
+    def model(self, name=GEMINI_MODEL, generation_config=None):
+        """Zwraca (tworząc przy pierwszym użyciu) uchwyt modelu dla danej konfiguracji."""
+        key = (name, json.dumps(generation_config, sort_keys=True, default=str))
+        with self._lock:
+            if not self._configured:
+                genai.configure(api_key=self.api_key)
+                self._configured = True
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(name, generation_config=generation_config)
+                self._models[key] = model
+        self.last_used = time.monotonic()
+        return model
+
+    def warm_up(self, name=GEMINI_MODEL):
+        """Otwiera połączenie z API tanim zapytaniem (count_tokens), zanim przyjdzie mail."""
+        try:
+            # Też jest zapytaniem do API - liczy się do limitu RPM
+            rate_limiter.acquire(name, 0)
+            self.model(name).count_tokens("ping")
+            logging.info(f"Połączenie z Gemini ({name}) rozgrzane.")
+        except Exception as e:
+            logging.warning(f"Nie udało się rozgrzać połączenia z Gemini: {e}")
+
+    async def warm_up_async(self, name=GEMINI_MODEL):
+        """Asynchroniczna wersja warm_up (rozgrzewa klienta używanego przez *_async)."""
+        try:
+            await rate_limiter.acquire_async(name, 0)
+            await self.model(name).count_tokens_async("ping")
+            logging.info(f"Połączenie z Gemini ({name}, async) rozgrzane.")
+        except Exception as e:
+            logging.warning(f"Nie udało się rozgrzać połączenia z Gemini (async): {e}")
+
+    def is_idle(self):
+        """Czy od ostatniego użycia minęło więcej niż GEMINI_KEEPALIVE_SEC."""
+        return time.monotonic() - self.last_used > GEMINI_KEEPALIVE_SEC
+
+    def start_keepalive(self):
+        """Uruchamia wątek, który rozgrzewa połączenie po dłuższej bezczynności."""
+        def keepalive():
+            while True:
+                time.sleep(GEMINI_KEEPALIVE_SEC)
+                if self.is_idle():
+                    self.warm_up()
+        threading.Thread(target=keepalive, name="gemini-keepalive", daemon=True).start()
+
+    async def keepalive_async(self):
+        """Korutyna podtrzymująca połączenie w silniku async."""
+        while True:
+            await asyncio.sleep(GEMINI_KEEPALIVE_SEC)
+            if self.is_idle():
+                await self.warm_up_async()
+
+    def start_keepalive_async(self):
+        """Uruchamia keepalive_async jako zadanie w bieżącej pętli zdarzeń."""
+        self._keepalive_task = asyncio.create_task(self.keepalive_async())
+
+gemini_client = GeminiClient()
+
+# --- Limity zapytań do Gemini ---
+
+class TokenBucket:
+    """Wiadro żetonów uzupełniane w stałym tempie (pojemność = limit na minutę).
+
+    reserve() zawsze rezerwuje żetony (stan może zejść poniżej zera) i zwraca,
+    ile trzeba poczekać - dzięki temu kolejne zapytania ustawiają się w kolejce
+    i limit jest wykorzystywany w pełni, ale nigdy przekraczany.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Rezerwuje `amount` żetonów; zwraca czas oczekiwania w sekundach."""
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount):
+        """Koryguje stan o różnicę między szacunkiem a faktycznym zużyciem."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def available(self):
+        self._refill()
+        return max(0.0, self.tokens)
+
+def _parse_rate_limits(spec):
+    """Parsuje "model=RPM:TPM,..." do słownika {model: (rpm, tpm)}."""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, values = item.split("=", 1)
+        rpm, tpm = values.split(":")
+        limits[model.strip()] = (int(rpm), int(tpm))
+    return limits
+
+class RateLimiter:
+    """Ogranicza zapytania do Gemini do limitów RPM i TPM każdego modelu.
+
+    Zamiast dostawać 429 i gubić maile, zapytanie czeka na swoją kolej.
+    Bieżący zapas limitu jest wystawiany jako metryka.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits if limits is not None else _parse_rate_limits(GEMINI_RATE_LIMITS)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, model):
+        if model not in self._buckets:
+            rpm, tpm = self.limits.get(model, (GEMINI_DEFAULT_RPM, GEMINI_DEFAULT_TPM))
+            self._buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+        return self._buckets[model]
+
+    def _reserve(self, model, tokens):
+        with self._lock:
+            requests, token_bucket = self._buckets_for(model)
+            wait = max(requests.reserve(1), token_bucket.reserve(tokens))
+            self._publish(model, requests, token_bucket)
+        if wait > 0:
+            metrics.inc("gemini_rate_limited")
+            logging.info(f"Limit Gemini ({model}) - czekam {wait:.1f} s.")
+        return wait
+
+    def _reserve_before(self, model, tokens, deadline):
+        """Rezerwuje limit; gdy kolejka nie zostawia GEMINI_MIN_CALL_SEC przed `deadline`,
+        oddaje rezerwację i rzuca GeminiUnavailable (mail zostanie odłożony)."""
+        wait = self._reserve(model, tokens)
+        if deadline is not None and time.monotonic() + wait + GEMINI_MIN_CALL_SEC > deadline:
+            self.release(model, tokens)
+            metrics.inc("gemini_rate_limit_deferred")
+            raise GeminiUnavailable(f"kolejka limitu {model} ({wait:.0f} s) przekracza termin zapytania")
+        return wait
+
+    def acquire(self, model, tokens, deadline=None):
+        """Blokuje wątek, aż zapytanie o szacowanej liczbie tokenów zmieści się w limicie."""
+        wait = self._reserve_before(model, tokens, deadline)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, model, tokens, deadline=None):
+        """Wersja dla korutyn - czeka bez blokowania pętli zdarzeń."""
+        wait = self._reserve_before(model, tokens, deadline)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, model, tokens, request=True):
+        """Oddaje rezerwację zapytania, które nie zużyło limitu (`request` - także slot RPM)."""
+        with self._lock:
+            requests, token_bucket = self._buckets_for(model)
+            if request:
+                requests.adjust(-1)
+            token_bucket.adjust(-tokens)
+            self._publish(model, requests, token_bucket)
+
+    def record_usage(self, model, estimated, actual):
+        """Uwzględnia faktyczne zużycie tokenów zamiast szacunku."""
+        if actual is None:
+            return
+        with self._lock:
+            requests, token_bucket = self._buckets_for(model)
+            token_bucket.adjust(actual - estimated)
+            self._publish(model, requests, token_bucket)
+
+    def headroom(self, model):
+        """Zwraca (wolne zapytania, wolne tokeny) w bieżącej minucie."""
+        with self._lock:
+            requests, token_bucket = self._buckets_for(model)
+            return requests.available(), token_bucket.available()
+
+    def _publish(self, model, requests, token_bucket):
+        metrics.set(f"gemini_rpm_headroom[{model}]", int(requests.available()))
+        metrics.set(f"gemini_tpm_headroom[{model}]", int(token_bucket.available()))
+
+rate_limiter = RateLimiter()
+
+def estimate_prompt_tokens(text):
+    """Zgrubny szacunek liczby tokenów tekstu (ok. 4 znaki na token)."""
+    return len(text) // 4 + 1
+
+def contents_text(contents):
+    """Tekst zapytania - prompt albo lista tur rozmowy ({"role": ..., "parts": [...]})."""
+    if isinstance(contents, str):
+        return contents
+    return "\n".join(part for turn in contents for part in turn["parts"])
+
+def estimate_tokens(prompt):
+    """Szacunek tokenów całego zapytania: prompt (lub rozmowa) plus zakładana odpowiedź."""
+    return estimate_prompt_tokens(contents_text(prompt)) + GEMINI_EXPECTED_OUTPUT_TOKENS
+
+def _total_tokens(response):
+    """Faktyczna liczba tokenów z metadanych odpowiedzi (jeśli są)."""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+# --- Odporność na błędy Gemini (ponawianie, bezpiecznik) ---
+
+class GeminiUnavailable(Exception):
+    """Gemini chwilowo nie odpowiada - maila nie zatwierdzamy, wróci później."""
+
+# Błędy google.api_core, po których warto spróbować ponownie
+_RETRYABLE_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                     "InternalServerError", "BadGateway", "GatewayTimeout", "Aborted"}
+
+def is_retryable_error(error):
+    """Klasyfikuje błąd: True = przejściowy (ponawiamy), False = trwały (np. zły prompt)."""
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    if type(error).__name__ in _RETRYABLE_ERRORS:
+        return True
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+class CircuitBreaker:
+    """Bezpiecznik: po serii błędów "otwiera się" na pewien czas.
+
+    W stanie otwartym zapytania od razu kończą się GeminiUnavailable, a
+    check_emails wstrzymuje pobieranie poczty. Po GEMINI_BREAKER_RESET_SEC
+    przepuszcza jedno zapytanie próbne - sukces zamyka bezpiecznik.
+    """
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, reset_after=GEMINI_BREAKER_RESET_SEC):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Czy bezpiecznik jest otwarty (i nie minął jeszcze czas do próby)."""
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_after
+
+    def allow_request(self):
+        """Czy można teraz wysłać zapytanie (w stanie półotwartym - tylko jedno)."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_after or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info("Gemini znów odpowiada - zamykam bezpiecznik.")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+            metrics.set("gemini_breaker_open", 0)
+
+    def abandon_probe(self):
+        """Zapytanie próbne nie zostało wysłane - kolejne może spróbować."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                logging.error(f"Gemini nie odpowiada ({self.failures} błędów z rzędu) - otwieram bezpiecznik na {self.reset_after} s.")
+                self.opened_at = time.monotonic()
+                metrics.set("gemini_breaker_open", 1)
+            self._probing = False
+
+gemini_breaker = CircuitBreaker()
+
+def _retry_delay(attempt, error, deadline):
+    """Zwraca opóźnienie przed kolejną próbą albo rzuca GeminiUnavailable, gdy nie ma już sensu."""
+    gemini_breaker.record_failure()
+    metrics.inc("gemini_retryable_errors")
+    # Wykładniczo rosnące opóźnienie z pełnym losowym rozrzutem (full jitter)
+    delay = random.uniform(0, min(GEMINI_RETRY_MAX_SEC, GEMINI_RETRY_BASE_SEC * 2 ** (attempt - 1)))
+    if attempt >= GEMINI_MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+        raise GeminiUnavailable(f"Gemini nie odpowiedziało po {attempt} próbach: {error}") from error
+    logging.warning(f"Przejściowy błąd Gemini (próba {attempt}): {error}. Ponawiam za {delay:.1f} s.")
+    return delay
+
+def _check_breaker():
+    if not gemini_breaker.allow_request():
+        raise GeminiUnavailable("bezpiecznik Gemini jest otwarty")
+
+def _acquire_or_defer(estimated, deadline):
+    """Czeka na limit; za długa kolejka odkłada mail bez liczenia błędu w bezpieczniku."""
+    try:
+        rate_limiter.acquire(GEMINI_MODEL, estimated, deadline)
+    except GeminiUnavailable:
+        gemini_breaker.abandon_probe()
+        raise
+
+async def _acquire_or_defer_async(estimated, deadline):
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content(prompt)
-        
-        # Sprawdzenie, czy odpowiedź nie została zablokowana
-        if not response.parts:
+        await rate_limiter.acquire_async(GEMINI_MODEL, estimated, deadline)
+    except GeminiUnavailable:
+        gemini_breaker.abandon_probe()
+        raise
+
+# --- Generowanie strumieniowe ---
+
+# Dopisywane do odpowiedzi przerwanej z powodu limitu długości lub czasu
+TRUNCATED_NOTE = "\n\n[Odpowiedź została skrócona.]"
+
+class AnswerBuffer:
+    """Zbiera kawałki strumienia Gemini z limitem długości i czasu generowania."""
+
+    def __init__(self, max_chars=GEMINI_MAX_ANSWER_CHARS, budget_sec=GEMINI_GENERATION_BUDGET_SEC):
+        self.max_chars = max_chars
+        self.budget_sec = budget_sec
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.parts = []
+        self.length = 0
+        self.truncated = False
+        self.usage = None
+
+    def add(self, chunk):
+        """Dodaje kawałek; zwraca False, gdy przekroczono limit i strumień trzeba przerwać."""
+        self.usage = _total_tokens(chunk) or self.usage
+        try:
+            text = chunk.text
+        except ValueError:
+            text = ""  # Kawałek bez tekstu (np. zablokowany)
+        if text and self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            metrics.observe("gemini_ttft_sec", self.first_token_at - self.started)
+        room = self.max_chars - self.length
+        if len(text) > room:
+            text = text[:room]
+            self.truncated = True
+        self.parts.append(text)
+        self.length += len(text)
+        if time.monotonic() - self.started > self.budget_sec:
+            self.truncated = True
+        return not self.truncated
+
+    def result(self):
+        """Kończy pomiar i zwraca zebraną odpowiedź."""
+        metrics.observe("gemini_generation_sec", time.monotonic() - self.started)
+        text = "".join(self.parts)
+        if not text:
             logging.warning("Odpowiedź Gemini była pusta lub zablokowana (safety reasons).")
-            return "Niestety, nie mogę wygenerować odpowiedzi na ten temat (odpowiedź zablokowana)."
-            
-        return response.text
-    except Exception as e:
-        logging.error(f"Błąd podczas komunikacji z API Gemini: {e}")
-        return None # Zwróć None, aby nie wysyłać odpowiedzi
+            return BLOCKED_ANSWER
+        if self.truncated:
+            metrics.inc("gemini_truncated_answers")
+            logging.warning(f"Przerwano generowanie po {self.length} znakach / {time.monotonic() - self.started:.0f} s.")
+            text += TRUNCATED_NOTE
+        return text
+
+def generate_streaming(model, prompt, timeout):
+    """Generuje odpowiedź strumieniowo; zwraca (tekst, zużyte tokeny)."""
+    buffer = AnswerBuffer()
+    response = model.generate_content(prompt, stream=True, request_options={"timeout": timeout})
+    for chunk in response:
+        if not buffer.add(chunk):
+            break  # Porzucenie iteratora przerywa strumień
+    return buffer.result(), buffer.usage
+
+async def generate_streaming_async(model, prompt, timeout):
+    """Asynchroniczna wersja generate_streaming - inne zapytania działają między kawałkami."""
+    buffer = AnswerBuffer()
+    response = await model.generate_content_async(prompt, stream=True, request_options={"timeout": timeout})
+    async for chunk in response:
+        if not buffer.add(chunk):
+            break
+    return buffer.result(), buffer.usage
+
+def get_gemini_response(prompt):
+    """Wysyła prompt (albo listę tur rozmowy) do Gemini i zwraca odpowiedź.
+
+    Błędy przejściowe są ponawiane (z wykładniczym opóźnieniem, w granicach
+    GEMINI_DEADLINE_SEC); gdy to nie pomoże, rzuca GeminiUnavailable. Przy
+    trwałym błędzie zwraca None (nie ma sensu ponawiać).
+    """
+    deadline = time.monotonic() + GEMINI_DEADLINE_SEC
+    attempt = 0
+    while True:
+        _check_breaker()
+        attempt += 1
+        estimated = estimate_tokens(prompt)
+        _acquire_or_defer(estimated, deadline)
+        try:
+            model = gemini_client.model()
+            timeout = max(1.0, deadline - time.monotonic())
+            if GEMINI_STREAMING:
+                text, usage = generate_streaming(model, prompt, timeout)
+            else:
+                started = time.monotonic()
+                response = model.generate_content(prompt, request_options={"timeout": timeout})
+                metrics.observe("gemini_generation_sec", time.monotonic() - started)
+                text, usage = _response_text(response), _total_tokens(response)
+            rate_limiter.record_usage(GEMINI_MODEL, estimated, usage)
+            gemini_breaker.record_success()
+            return text
+        except Exception as e:
+            # Nieudane zapytanie nie zużyło tokenów (slot RPM zostaje zajęty)
+            rate_limiter.release(GEMINI_MODEL, estimated, request=False)
+            if not is_retryable_error(e):
+                # Serwis działa, tylko zapytanie jest złe - to nie awaria
+                gemini_breaker.record_success()
+                logging.error(f"Błąd podczas komunikacji z API Gemini: {e}")
+                return None # Zwróć None, aby nie wysyłać odpowiedzi
+            time.sleep(_retry_delay(attempt, e, deadline))
+
+async def get_gemini_response_async(prompt):
+    """Asynchroniczna wersja get_gemini_response (generate_content_async)."""
+    deadline = time.monotonic() + GEMINI_DEADLINE_SEC
+    attempt = 0
+    while True:
+        _check_breaker()
+        attempt += 1
+        estimated = estimate_tokens(prompt)
+        await _acquire_or_defer_async(estimated, deadline)
+        try:
+            model = gemini_client.model()
+            timeout = max(1.0, deadline - time.monotonic())
+            if GEMINI_STREAMING:
+                text, usage = await generate_streaming_async(model, prompt, timeout)
+            else:
+                started = time.monotonic()
+                response = await model.generate_content_async(prompt, request_options={"timeout": timeout})
+                metrics.observe("gemini_generation_sec", time.monotonic() - started)
+                text, usage = _response_text(response), _total_tokens(response)
+            rate_limiter.record_usage(GEMINI_MODEL, estimated, usage)
+            gemini_breaker.record_success()
+            return text
+        except Exception as e:
+            rate_limiter.release(GEMINI_MODEL, estimated, request=False)
+            if not is_retryable_error(e):
+                gemini_breaker.record_success()
+                logging.error(f"Błąd podczas komunikacji z API Gemini: {e}")
+                return None
+            await asyncio.sleep(_retry_delay(attempt, e, deadline))
+
+# --- Konwersja HTML -> tekst (maile bez części text/plain) ---
+
+def compact_url(href):
+    """Zwięzła postać adresu linku: bez schematu, parametrów i fragmentu, najwyżej 60 znaków."""
+    if not href or href.startswith(("#", "javascript:", "data:", "cid:")):
+        return None
+    if href.startswith("mailto:"):
+        return href[7:].split("?")[0]
+    parts = urllib.parse.urlsplit(href)
+    url = (parts.netloc + parts.path).rstrip("/")
+    return url[:60] + "..." if len(url) > 60 else url
+
+class HtmlToText(html.parser.HTMLParser):
+    """Strumieniowy konwerter HTML -> zwykły tekst (dane można podawać kawałkami).
+
+    Pomija skrypty, style i <head>, zwija białe znaki, bloki zamienia na
+    nowe linie, a linki zapisuje zwięźle jako "tekst <host/ścieżka>". Po
+    osiągnięciu limitu długości dalsze dane są ignorowane (`full`).
+    """
+
+    _SKIP = {"script", "style", "head", "title", "noscript", "template", "svg", "object"}
+    _BLOCK = {"p", "div", "br", "tr", "table", "ul", "ol", "li", "blockquote", "hr", "pre",
+              "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "header", "footer"}
+
+    def __init__(self, max_chars=HTML_TEXT_MAX_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.full = False
+        self._parts = []
+        self._size = 0
+        self._skip_depth = 0
+        self._link = None  # (zwięzły adres, indeks pierwszego kawałka tekstu linku)
+
+    def _emit(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.max_chars:
+            self.full = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip_depth += 1
+        elif self._skip_depth:
+            return
+        elif tag in self._BLOCK:
+            self._emit("\n- " if tag == "li" else "\n")
+        elif tag in ("td", "th"):
+            self._emit(" ")
+        elif tag == "a":
+            url = compact_url(dict(attrs).get("href"))
+            self._link = (url, len(self._parts)) if url else None
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif self._skip_depth:
+            return
+        elif tag in self._BLOCK and tag != "li":
+            self._emit("\n")
+        elif tag == "a" and self._link:
+            url, start = self._link
+            self._link = None
+            label = "".join(self._parts[start:]).strip()
+            # Link bez tekstu (np. obrazek) pomijamy; adres podajemy, gdy nie ma go w tekście
+            if label and url not in label:
+                self._emit(f" <{url}>")
+
+    def handle_data(self, data):
+        if not self._skip_depth and not self.full:
+            # Znaki nowej linii w źródle HTML to zwykłe odstępy
+            self._emit(re.sub(r"\s+", " ", data))
+
+    def text(self):
+        """Wynikowy tekst (z zwiniętymi białymi znakami, najwyżej max_chars znaków)."""
+        if not self.full:
+            self.close()
+        text = re.sub(r"[ \xa0]+", " ", "".join(self._parts))
+        text = re.sub(r" *\n *", "\n", text)
+        text = re.sub(r"\n{3,}", "\n\n", text).strip()
+        return text[:self.max_chars]
+
+def html_to_text(markup, max_chars=HTML_TEXT_MAX_CHARS, chunk_size=64 * 1024):
+    """Zamienia HTML na tekst; przestaje parsować po osiągnięciu limitu długości."""
+    converter = HtmlToText(max_chars)
+    for offset in range(0, len(markup), chunk_size):
+        converter.feed(markup[offset:offset + chunk_size])
+        if converter.full:
+            break
+    return converter.text()
+
+def _decode_part(part):
+    """Dekoduje treść części wiadomości zgodnie z jej charsetem."""
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+    except LookupError:
+        return payload.decode(errors='ignore')
 
 # --- Logika E-mail ---
 
 def parse_email_body(msg):
-    """Próbuje wyciągnąć "czystą" treść (prompt) z wiadomości e-mail."""
+    """Próbuje wyciągnąć "czystą" treść (prompt) z wiadomości e-mail.
+
+    Gdy nie ma części text/plain, bierze pierwszą część text/html zamienioną na tekst.
+    """
+    html_part = None
     # Priorytet to "text/plain"
     if msg.is_multipart():
         for part in msg.walk():
             ctype = part.get_content_type()
             cdispo = str(part.get("Content-Disposition"))
 
+            if ctype == "text/html" and "attachment" not in cdispo and html_part is None:
+                html_part = part
+
             # Szukamy części "text/plain", która nie jest załącznikiem
             if ctype == "text/plain" and "attachment" not in cdispo:
                 try:
@@ -76,6 +867,8 @@ def parse_email_body(msg):
                     logging.warning(f"Błąd dekodowania części maila: {e}")
                     # Spróbuj domyślnego dekodowania
                     return part.get_payload(decode=True).decode(errors='ignore')
+    elif msg.get_content_type() == "text/html":
+        html_part = msg
     else:
         # Mail nie jest multipart, bierzemy główną treść
         try:
@@ -84,33 +877,292 @@ def parse_email_body(msg):
         except Exception as e:
             logging.warning(f"Błąd dekodowania maila (non-multipart): {e}")
             return None
+
+    if html_part is not None:
+        return html_to_text(_decode_part(html_part))
     
     return None # Nie znaleziono pasującej treści
 
-def send_reply(to_address, subject, original_msg_id, body):
-    """Wysyła wiadomość e-mail jako odpowiedź (z zachowaniem wątku)."""
+def is_smtp_connection_error(error):
+    """Czy błąd dotyczy samego połączenia (a nie tej jednej wiadomości).
+
+    SMTPException dziedziczy po OSError, więc odrzucenie adresata czy 5xx
+    na DATA trzeba odróżnić od zerwanego gniazda.
+    """
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+def is_smtp_permanent_error(error):
+    """Czy ponawianie wysyłki tej wiadomości nie ma sensu (5xx, odrzuceni adresaci)."""
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500 \
+        or isinstance(error, smtplib.SMTPRecipientsRefused)
+
+class _PooledSmtp:
+    """Jedno zalogowane połączenie SMTP wraz z licznikami do recyklingu."""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.sent = 0
+
+class SmtpPool:
+    """Pula długo żyjących, zalogowanych połączeń SMTP.
+
+    Połączenie jest sprawdzane komendą NOOP po dłuższej bezczynności i
+    odnawiane po SMTP_MAX_MESSAGES wiadomościach lub SMTP_MAX_AGE_SEC sekundach,
+    dzięki czemu wiele odpowiedzi idzie jedną sesją bez ponownego TLS i LOGIN.
+    """
+
+    def __init__(self, host=SMTP_SERVER, port=SMTP_PORT, user=EMAIL_ADDRESS, password=EMAIL_PASSWORD, size=SMTP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(size, 1))
+
+    def _open(self):
+        logging.info("Łączenie z serwerem SMTP...")
+        smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT_SEC)
+        smtp.login(self.user, self.password)
+        return _PooledSmtp(smtp)
+
+    def _close(self, conn):
+        try:
+            conn.smtp.quit()
+        except Exception:
+            pass
+
+    def _is_usable(self, conn):
+        """Czy połączenie z puli nadaje się do ponownego użycia."""
+        now = time.monotonic()
+        if conn.sent >= SMTP_MAX_MESSAGES or now - conn.created > SMTP_MAX_AGE_SEC:
+            return False
+        if now - conn.last_used > SMTP_NOOP_AFTER_SEC:
+            try:
+                return conn.smtp.noop()[0] == 250
+            except Exception:
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Wypożycza połączenie z puli (blokuje, gdy wszystkie są zajęte)."""
+        with self._slots:
+            conn = None
+            while conn is None:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._open()
+                    break
+                if not self._is_usable(conn):
+                    self._close(conn)
+                    conn = None
+            try:
+                yield conn
+            except Exception as e:
+                # Po błędzie połączenia nie ufamy mu; po odrzuceniu wiadomości
+                # (smtplib wysłał już RSET) nadaje się do dalszej pracy
+                if is_smtp_connection_error(e) or not isinstance(e, smtplib.SMTPException):
+                    self._close(conn)
+                else:
+                    conn.last_used = time.monotonic()
+                    self._idle.put(conn)
+                raise
+            conn.last_used = time.monotonic()
+            self._idle.put(conn)
+
+    def send(self, from_addr, to_addrs, raw):
+        """Wysyła wiadomość; jeśli stare połączenie okaże się zerwane, próbuje raz na nowym."""
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    conn.smtp.sendmail(from_addr, to_addrs, raw)
+                    conn.sent += 1
+                return
+            except Exception as e:
+                # Błędy dotyczące samej wiadomości (5xx, odrzuceni adresaci) nie są ponawiane
+                if attempt == 1 or not is_smtp_connection_error(e):
+                    raise
+                logging.warning("Błąd połączenia SMTP - ponawiam na nowym połączeniu.")
+
+smtp_pool = SmtpPool()
+
+# --- Trwała skrzynka nadawcza (outbox) ---
+
+class Outbox:
+    """Trwała kolejka gotowych odpowiedzi w SQLite.
+
+    Odpowiedź trafia tu, zanim spróbujemy ją wysłać, więc przejściowy błąd
+    SMTP nie gubi wygenerowanej (i opłaconej) odpowiedzi Gemini. Nieudane
+    wysyłki są ponawiane z wykładniczym opóźnieniem i losowym rozrzutem,
+    a zaległości wysyłane partiami na jednym połączeniu z puli.
+    """
+
+    def __init__(self, path, pool):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.pool = pool
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                next_attempt REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'pending',
+                from_addr TEXT NOT NULL,
+                to_addr TEXT NOT NULL,
+                message BLOB NOT NULL,
+                last_error TEXT
+            )""")
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def put(self, msg):
+        """Zapisuje wiadomość na dysku i rezerwuje ją dla bieżącego wątku; zwraca jej id."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (created, next_attempt, from_addr, to_addr, message) VALUES (?, ?, ?, ?, ?)",
+                (now, now + OUTBOX_CLAIM_SEC, msg['From'], msg['To'], msg.as_bytes()))
+            return cursor.lastrowid
+
+    def _claim_due(self, limit):
+        """Pobiera zaległe wiadomości i rezerwuje je, by nikt inny ich nie wysłał."""
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, attempts, from_addr, to_addr, message FROM outbox "
+                "WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            if rows:
+                self._db.executemany("UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                                     [(now + OUTBOX_CLAIM_SEC, row[0]) for row in rows])
+        return rows
+
+    def _mark_sent(self, row_id, to_addr):
+        with self._lock:
+            self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        logging.info(f"Odpowiedź wysłana pomyślnie do {to_addr}.")
+
+    def _mark_failed(self, row_id, attempts, error, permanent=None):
+        """Planuje kolejną próbę (backoff z rozrzutem) albo odkłada wiadomość na bok.
+
+        `permanent=False` wymusza ponowienie - dla błędów, które nie dotyczą
+        tej wiadomości (np. nieudane logowanie przy otwieraniu połączenia).
+        """
+        attempts += 1
+        if permanent is None:
+            permanent = is_smtp_permanent_error(error)
+        if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+            status, delay = "dead", 0
+            logging.error(f"Odpowiedź id={row_id} nie zostanie wysłana (próba {attempts}): {error}")
+        else:
+            status = "pending"
+            delay = min(OUTBOX_RETRY_BASE_SEC * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SEC)
+            delay *= random.uniform(0.5, 1.5)
+            logging.warning(f"Nie udało się wysłać odpowiedzi id={row_id} (próba {attempts}): {error}. Ponowienie za {delay:.0f} s.")
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET attempts = ?, status = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                (attempts, status, time.time() + delay, str(error), row_id))
+
+    def send_now(self, row_id, msg):
+        """Próbuje od razu wysłać właśnie zapisaną wiadomość (zarezerwowaną przez put)."""
+        try:
+            self.pool.send(msg['From'], [msg['To']], msg.as_bytes())
+            self._mark_sent(row_id, msg['To'])
+        except Exception as e:
+            self._mark_failed(row_id, 0, e)
+
+    def flush(self):
+        """Wysyła zaległe wiadomości partiami, każdą partię jednym połączeniem."""
+        if not self._flush_lock.acquire(blocking=False):
+            return  # Inny wątek właśnie opróżnia kolejkę
+        try:
+            while True:
+                rows = self._claim_due(OUTBOX_BATCH_SIZE)
+                if not rows:
+                    return
+                remaining = list(rows)
+                try:
+                    with self.pool.connection() as conn:
+                        while remaining:
+                            row_id, attempts, from_addr, to_addr, raw = remaining[0]
+                            try:
+                                conn.smtp.sendmail(from_addr, [to_addr], raw)
+                                conn.sent += 1
+                                self._mark_sent(row_id, to_addr)
+                            except Exception as e:
+                                if is_smtp_connection_error(e):
+                                    raise
+                                # Odrzucona tylko ta wiadomość - połączenie działa dalej
+                                self._mark_failed(row_id, attempts, e)
+                            remaining.pop(0)
+                except Exception as e:
+                    # Połączenie padło - reszta partii czeka na kolejną próbę
+                    for row_id, attempts, _, _, _ in remaining:
+                        self._mark_failed(row_id, attempts, e, permanent=False)
+                    return
+        finally:
+            self._flush_lock.release()
+
+    def start_flusher(self):
+        """Uruchamia wątek, który co OUTBOX_FLUSH_INTERVAL_SEC ponawia zaległe wysyłki."""
+        def flusher():
+            while True:
+                time.sleep(OUTBOX_FLUSH_INTERVAL_SEC)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"Błąd podczas opróżniania skrzynki nadawczej: {e}", exc_info=True)
+        threading.Thread(target=flusher, name="outbox", daemon=True).start()
+
+outbox = Outbox(os.path.join(STATE_DIR, "outbox.sqlite3"), smtp_pool)
+
+def new_message_id(address=EMAIL_ADDRESS):
+    """Nowy, unikalny Message-ID w domenie naszego adresu."""
+    return make_msgid(domain=address.rpartition("@")[2] or None)
+
+def send_reply(to_address, subject, original_msg_id, body, references=None, message_id=None, account=None):
+    """Zapisuje odpowiedź w skrzynce nadawczej (z zachowaniem wątku) i próbuje ją wysłać.
+
+    `references` to nagłówek References oryginału - dopisujemy do niego jego
+    Message-ID, by klient poczty (i my) mógł odtworzyć cały wątek. `account`
+    to konto, z którego odpowiadamy (domyślnie EMAIL_ADDRESS).
+
+    Zwraca True, gdy odpowiedź jest bezpiecznie zapisana na dysku - nawet jeśli
+    sama wysyłka się nie udała (zostanie ponowiona przez skrzynkę nadawczą).
+    """
+    account = account or default_account
     logging.info(f"Przygotowuję odpowiedź do: {to_address}")
     
     # Tworzenie obiektu wiadomości
     msg = EmailMessage()
-    msg['From'] = EMAIL_ADDRESS
+    msg['From'] = account.address
     msg['To'] = to_address
     msg['Subject'] = f"Re: {subject}"
     
     # Te nagłówki są KLUCZOWE, aby klient poczty rozpoznał to jako odpowiedź
-    msg['In-Reply-To'] = original_msg_id
-    msg['References'] = original_msg_id
+    msg['Message-ID'] = message_id or new_message_id(account.address)
+    if original_msg_id:
+        msg['In-Reply-To'] = original_msg_id
+        msg['References'] = " ".join(message_ids(references) + [original_msg_id])
     
     msg.set_content(body)
 
-    # Logowanie do serwera SMTP i wysyłka
     try:
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            smtp.send_message(msg)
-        logging.info(f"Odpowiedź wysłana pomyślnie do {to_address}.")
+        row_id = account.outbox.put(msg)
     except Exception as e:
-        logging.error(f"Nie udało się wysłać e-maila: {e}")
+        logging.error(f"Nie udało się zapisać odpowiedzi w skrzynce nadawczej: {e}")
+        return False
+
+    # Wysyłka przez współdzieloną pulę zalogowanych połączeń SMTP
+    account.outbox.send_now(row_id, msg)
+    return True
 
 def decode_subject(subject):
     """Poprawnie dekoduje temat e-maila (który może być w różnych formatach)."""
@@ -123,96 +1175,2340 @@ def decode_subject(subject):
             subject_str += part
     return subject_str.strip() or "Brak tematu"
 
-def check_emails():
-    """Główna funkcja sprawdzająca i przetwarzająca nowe e-maile."""
-    logging.info("Łączenie z serwerem IMAP...")
-    
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        mail.select("inbox")
-        logging.info("Połączono. Sprawdzam nieprzeczytane wiadomości...")
+class ImapSession:
+    """Długo żyjąca sesja IMAP współdzielona przez kolejne cykle sprawdzania poczty.
 
-        # Wyszukaj tylko nieprzeczytane wiadomości
-        status, data = mail.search(None, "UNSEEN")
-        if status != "OK":
-            logging.error("Nie udało się przeszukać skrzynki.")
-            mail.logout()
-            return
+    Zamiast logować się przy każdym sprawdzeniu, trzymamy jedno połączenie,
+    sprawdzamy je komendą NOOP po dłuższej bezczynności i łączymy się ponownie
+    (z wykładniczym opóźnieniem), gdy gniazdo okaże się martwe.
+    """
 
-        mail_ids = data[0].split()
-        if not mail_ids:
-            logging.info("Brak nowych wiadomości.")
-            mail.logout()
-            return
+    def __init__(self, host=IMAP_SERVER, user=EMAIL_ADDRESS, password=EMAIL_PASSWORD, mailbox="inbox"):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.mail = None
+        self.selected_mailbox = None
+        self.uidvalidity = None
+        self.last_used = 0.0
+        self._reconnect_delay = IMAP_RECONNECT_MIN_SEC
+
+    def _connect(self):
+        """Łączy się i loguje, ponawiając próby z wykładniczym opóźnieniem."""
+        while True:
+            try:
+                logging.info("Łączenie z serwerem IMAP...")
+                mail = imaplib.IMAP4_SSL(self.host, timeout=IMAP_TIMEOUT_SEC)
+                mail.login(self.user, self.password)
+                logging.info("Połączono.")
+                self._reconnect_delay = IMAP_RECONNECT_MIN_SEC
+                return mail
+            except Exception as e:
+                logging.error(f"Nie udało się połączyć z IMAP: {e}. Ponowna próba za {self._reconnect_delay} s.")
+                time.sleep(self._reconnect_delay)
+                self._reconnect_delay = min(self._reconnect_delay * 2, IMAP_RECONNECT_MAX_SEC)
+
+    def _is_alive(self):
+        """Sprawdza komendą NOOP, czy połączenie wciąż działa."""
+        try:
+            status, _ = self.mail.noop()
+            return status == "OK"
+        except Exception as e:
+            logging.warning(f"Połączenie IMAP nie odpowiada na NOOP: {e}")
+            return False
+
+    def get(self):
+        """Zwraca działające połączenie z wybraną skrzynką (łączy się w razie potrzeby)."""
+        if self.mail is not None and time.monotonic() - self.last_used > IMAP_NOOP_AFTER_SEC:
+            if not self._is_alive():
+                self.invalidate()
 
-        logging.info(f"Znaleziono {len(mail_ids)} nowych wiadomości.")
+        if self.mail is None:
+            self.mail = self._connect()
+            self.selected_mailbox = None
 
-        for mail_id in mail_ids:
-            # Pobierz pełną wiadomość
-            status, msg_data = mail.fetch(mail_id, "(RFC822)")
+        # SELECT tylko wtedy, gdy stan skrzynki się zmienił (nowe połączenie,
+        # inna skrzynka lub serwer wyszedł ze stanu SELECTED)
+        if self.selected_mailbox != self.mailbox or self.mail.state != "SELECTED":
+            status, _ = self.mail.select(self.mailbox)
             if status != "OK":
-                logging.warning(f"Nie udało się pobrać maila ID: {mail_id}")
-                continue
+                raise imaplib.IMAP4.error(f"Nie udało się wybrać skrzynki {self.mailbox}")
+            self.selected_mailbox = self.mailbox
+            # SELECT zwraca UIDVALIDITY - potrzebne do synchronizacji po UID
+            uidvalidity = self.mail.untagged_responses.pop("UIDVALIDITY", [None])[-1]
+            self.uidvalidity = int(uidvalidity) if uidvalidity else None
+
+        self.touch()
+        return self.mail
+
+    def touch(self):
+        """Zapamiętuje moment ostatniego użycia połączenia."""
+        self.last_used = time.monotonic()
+
+    def invalidate(self):
+        """Porzuca bieżące połączenie - następne get() połączy się od nowa."""
+        if self.mail is not None:
+            try:
+                self.mail.logout()
+            except Exception:
+                pass
+        self.mail = None
+        self.selected_mailbox = None
+        self.uidvalidity = None
+
+# Wspólna sesja używana przez check_emails i pętlę IDLE
+imap_session = ImapSession()
+
+# --- Synchronizacja po UID ---
 
-            # Parsuj wiadomość
-            raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
+class SyncCheckpoint:
+    """Zapisany na dysku stan synchronizacji: UIDVALIDITY i najwyższy przetworzony UID.
 
-            # Pobierz kluczowe informacje
-            sender_email = parseaddr(msg['From'])[1] # Czysty adres e-mail nadawcy
-            subject = decode_subject(msg['Subject'])
-            msg_id = msg['Message-ID'] # Ważne dla odpowiedzi w wątku
+    W pamięci trzyma też maile obsługiwane w tle przez potok - punkt kontrolny
+    przesuwa się tylko za UID, które zostały w całości zatwierdzone.
+    """
 
-            # --- GŁÓWNA LOGIKA AGENTA ---
-            
-            # 1. Sprawdź, czy to nie jest mail od nas samych (ważne!)
-            if sender_email == EMAIL_ADDRESS:
-                logging.info(f"Pominięto maila od samego siebie (ID: {mail_id}).")
+    def __init__(self, path):
+        self.path = path
+        self.uidvalidity = None
+        self.last_uid = 0
+        self.in_flight = set()      # UID przekazane do potoku, jeszcze nieobsłużone
+        self.committed = set()      # UID zatwierdzone, powyżej last_uid
+        self.failed = {}            # UID -> liczba nieudanych prób wysyłki
+        self.done = queue.Queue()   # (uid, ok) zgłaszane przez wątki potoku
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.uidvalidity = data.get("uidvalidity")
+            self.last_uid = data.get("last_uid", 0)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Nie udało się wczytać punktu kontrolnego {path}: {e}")
+
+    def save(self):
+        """Zapisuje stan atomowo (plik tymczasowy + os.replace)."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"uidvalidity": self.uidvalidity, "last_uid": self.last_uid}, f)
+        os.replace(tmp_path, self.path)
+
+    def advance(self, uid):
+        """Przesuwa punkt kontrolny za przetworzony UID."""
+        if uid > self.last_uid:
+            self.last_uid = uid
+            self.save()
+
+    def reset(self, uidvalidity, last_uid):
+        """Zaczyna nową serię UID (po pełnej resynchronizacji)."""
+        self.uidvalidity = uidvalidity
+        self.last_uid = last_uid
+        self.committed.clear()
+        self.save()
+
+    def is_pending(self, uid):
+        """Czy UID jest w trakcie obsługi albo już zatwierdzony (nie pobieramy go ponownie)."""
+        return uid in self.in_flight or uid in self.committed
+
+    def begin(self, uid):
+        """Oznacza UID jako przekazany do obsługi."""
+        self.in_flight.add(uid)
+
+    def forget(self, uid):
+        """Przestaje śledzić UID, którym zajęła się inna replika."""
+        self.in_flight.discard(uid)
+        self.failed.pop(uid, None)
+
+    def finish(self, uid, ok):
+        """Zapisuje wynik obsługi UID; zwraca True, jeśli mail należy oznaczyć jako przeczytany.
+
+        Mail, którego odpowiedzi nie udało się wysłać, zostaje niezatwierdzony
+        i zostanie pobrany ponownie - chyba że wyczerpał limit prób. Wynik None
+        (odłożony, np. gdy Gemini nie działa) nie zużywa prób.
+        """
+        self.in_flight.discard(uid)
+        if ok is None:
+            self.failed.setdefault(uid, 0)
+            return False
+        if not ok:
+            self.failed[uid] = self.failed.get(uid, 0) + 1
+            if self.failed[uid] < SEND_MAX_ATTEMPTS:
+                return False
+            logging.error(f"Mail ID: {uid} - wyczerpano {SEND_MAX_ATTEMPTS} prób wysyłki, pomijam go.")
+        self.failed.pop(uid, None)
+        self.committed.add(uid)
+        return True
+
+    def advance_watermark(self):
+        """Przesuwa punkt kontrolny za najwyższy UID, przed którym nic już nie czeka."""
+        blocked = self.in_flight | set(self.failed)
+        limit = min(blocked) - 1 if blocked else None
+        ready = [uid for uid in self.committed if limit is None or uid <= limit]
+        if ready:
+            self.advance(max(ready))
+        self.committed = {uid for uid in self.committed if uid > self.last_uid}
+
+def checkpoint_path(user, mailbox):
+    """Ścieżka pliku z punktem kontrolnym dla danego konta i skrzynki (i repliki)."""
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", f"{user}_{mailbox}")
+    if WORKER_COUNT > 1:
+        name += f"_w{WORKER_INDEX}"
+    return os.path.join(STATE_DIR, f"checkpoint_{name}.json")
+
+sync_checkpoint = SyncCheckpoint(checkpoint_path(EMAIL_ADDRESS, "inbox"))
+
+# --- Współpraca wielu replik (rezerwacje maili) ---
+
+class MessageClaims:
+    """Rezerwacje maili słowem kluczowym IMAP `$AgentClaimed_<czas>_<replika>`.
+
+    Replika dodaje swoje słowo kluczowe warunkowo (CONDSTORE, UNCHANGEDSINCE),
+    więc z dwóch równoczesnych prób udaje się tylko jedna. Potem sprawdza
+    flagi: właścicielem jest najstarsza ważna rezerwacja - także na serwerach
+    bez CONDSTORE wszystkie repliki dochodzą do tego samego wyniku. Rezerwacja
+    wygasa po CLAIM_TIMEOUT_SEC, więc maile, które wciąż obsługujemy, co
+    CLAIM_RENEW_AFTER_SEC dostają nowe słowo kluczowe; maile z wygasłą
+    rezerwacją co jakiś czas przejmujemy. Słowa kluczowe maili, które
+    przegraliśmy, od razu usuwamy. Rezerwujemy partiami (claim_batch) - tylko
+    tyle, ile potok zdoła od razu przyjąć.
+    """
+
+    def __init__(self, worker_id=WORKER_ID, timeout=CLAIM_TIMEOUT_SEC):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.held = {}  # UID -> nasze słowo kluczowe
+        self.reclaimable = set()  # UID do przejęcia, jeśli mają wygasłą rezerwację
+        self.last_reclaim = 0.0
+
+    def _claims(self, flags):
+        """Ważne rezerwacje z listy flag, posortowane od najstarszej: [(czas, replika, słowo)]."""
+        now = time.time()
+        claims = []
+        for flag in flags or ():
+            if isinstance(flag, str) and flag.startswith(CLAIM_KEYWORD_PREFIX):
+                stamp, _, worker = flag[len(CLAIM_KEYWORD_PREFIX):].partition("_")
+                if stamp.isdigit() and now - int(stamp) < self.timeout:
+                    claims.append((int(stamp), worker, flag))
+        return sorted(claims)
+
+    @staticmethod
+    def _stamp(keyword):
+        """Czas utworzenia rezerwacji zapisany w słowie kluczowym."""
+        stamp = keyword[len(CLAIM_KEYWORD_PREFIX):].partition("_")[0]
+        return int(stamp) if stamp.isdigit() else 0
+
+    def _new_keyword(self):
+        return f"{CLAIM_KEYWORD_PREFIX}{int(time.time())}_{self.worker_id}"
+
+    def _remove_keywords(self, mail, pairs):
+        """Usuwa nasze słowa kluczowe - `pairs` to [(uid, słowo)]."""
+        by_keyword = {}
+        for uid, keyword in pairs:
+            by_keyword.setdefault(keyword, []).append(uid)
+        for keyword, keyword_uids in by_keyword.items():
+            mail.uid("STORE", uid_set(keyword_uids), "-FLAGS.SILENT", f"({keyword})")
+
+    def _fetch_flags(self, mail, uids, modseq=False):
+        status, data = mail.uid("FETCH", uid_set(uids), "(UID FLAGS MODSEQ)" if modseq else "(UID FLAGS)")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Nie udało się pobrać flag dla {uid_set(uids)}")
+        return parse_fetch_response(data)
+
+    def claim(self, mail, uids, reclaim=()):
+        """Rezerwuje maile dla tej repliki; zwraca UID, które należą teraz do nas.
+
+        Pomija maile przeczytane i zarezerwowane przez inne repliki. Maile
+        z `reclaim` bierze tylko wtedy, gdy mają rezerwację (wygasłą albo naszą).
+        """
+        if not uids:
+            return []
+        condstore = "CONDSTORE" in mail.capabilities
+        items = self._fetch_flags(mail, uids, modseq=condstore)
+        ours, candidates, modseqs, lost = [], [], [], []
+        for uid in uids:
+            flags = items.get(uid, {}).get("FLAGS") or []
+            claims = self._claims(flags)
+            if "\\Seen" in flags:
+                if uid in self.held:
+                    lost.append(uid)
+                continue
+            if uid in reclaim and not any(str(flag).startswith(CLAIM_KEYWORD_PREFIX) for flag in flags):
+                continue
+            if claims and claims[0][1] == self.worker_id:
+                ours.append(uid)
+            elif not claims:
+                candidates.append(uid)
+                modseq = items[uid].get("MODSEQ")
+                if modseq:
+                    modseqs.append(int(modseq[0]))
+            elif uid in self.held:
+                # Nasza rezerwacja wygasła i mail wzięła inna replika
+                lost.append(uid)
+
+        stale = [(uid, self.held.pop(uid)) for uid in lost]
+        if candidates:
+            keyword = self._new_keyword()
+            if condstore and modseqs:
+                # MODSEQ rośnie przy każdej zmianie - maile zmienione po naszym FETCH odpadną
+                mail.uid("STORE", uid_set(candidates), f"(UNCHANGEDSINCE {max(modseqs)})", "+FLAGS.SILENT", f"({keyword})")
             else:
-                logging.info(f"Przetwarzam maila od: {sender_email}, Temat: {subject}")
-                
-                # 2. Wyciągnij prompt z treści
-                prompt = parse_email_body(msg)
-
-                if not prompt:
-                    logging.warning(f"Nie znaleziono treści (text/plain) w mailu ID: {mail_id}.")
-                    # I tak oznaczamy jako przeczytany
+                mail.uid("STORE", uid_set(candidates), "+FLAGS.SILENT", f"({keyword})")
+            # Sprawdzamy, kto wygrał - rezerwacja mogła się udać równocześnie innej replice
+            items = self._fetch_flags(mail, candidates)
+            for uid in candidates:
+                claims = self._claims(items.get(uid, {}).get("FLAGS"))
+                if uid in self.held:
+                    # Wygasłe słowo z poprzedniej naszej rezerwacji
+                    stale.append((uid, self.held.pop(uid)))
+                if claims and claims[0][2] == keyword:
+                    ours.append(uid)
+                    self.held[uid] = keyword
                 else:
-                    # 3. Wykonaj prompt w Gemini
-                    logging.info("Wysyłam prompt do Gemini...")
-                    gemini_answer = get_gemini_response(prompt.strip())
+                    stale.append((uid, keyword))
+        if stale:
+            self._remove_keywords(mail, stale)
+        if lost:
+            metrics.inc("claims_lost", len(lost))
+            logging.warning(f"{len(lost)} maili przejęła inna replika: {uid_set(lost)}.")
 
-                    if gemini_answer:
-                        # 4. Odeślij odpowiedź
-                        send_reply(sender_email, subject, msg_id, gemini_answer)
-                    else:
-                        logging.error(f"Nie udało się uzyskać odpowiedzi Gemini dla maila ID: {mail_id}.")
+        reclaimed = [uid for uid in ours if uid in reclaim]
+        if reclaimed:
+            metrics.inc("claims_reclaimed", len(reclaimed))
+            logging.warning(f"Przejmuję {len(reclaimed)} maili z wygasłą rezerwacją.")
+        skipped = len(uids) - len(ours)
+        if skipped:
+            metrics.inc("claims_skipped", skipped)
+            logging.info(f"Pominięto {skipped} maili obsługiwanych przez inne repliki.")
+        return sorted(ours)
 
-            # 5. Oznacz mail jako przeczytany (Seen)
-            # Robimy to niezależnie od tego, czy się udało, aby nie utknąć
-            mail.store(mail_id, '+FLAGS', r'(\Seen)')
+    def reclaim_due(self, mail, checkpoint):
+        """Co CLAIM_RECLAIM_INTERVAL_SEC: nieprzeczytane maile, które mogą mieć wygasłą rezerwację.
 
-        mail.logout()
+        Niczego nie rezerwuje - coordinate() dokłada je do `reclaimable`
+        i są przejmowane partiami, razem z nowymi mailami.
+        """
+        if time.monotonic() - self.last_reclaim < CLAIM_RECLAIM_INTERVAL_SEC:
+            return []
+        self.last_reclaim = time.monotonic()
+        return [uid for uid in _uid_search(mail, "UNSEEN") if not checkpoint.is_pending(uid)]
 
-    except Exception as e:
-        logging.error(f"Wystąpił błąd w głównej funkcji check_emails: {e}", exc_info=True)
+    def renew(self, mail):
+        """Odnawia rezerwacje starsze niż CLAIM_RENEW_AFTER_SEC; zwraca UID utracone na rzecz innej repliki.
 
+        Nowe słowo kluczowe dodajemy przed usunięciem starego, więc mail ani
+        przez chwilę nie jest wolny. Wygasłe rezerwacje mogła już przejąć inna
+        replika - te rezerwujemy od nowa (claim). Maile przeczytane lub
+        usunięte w międzyczasie przestajemy trzymać.
+        """
+        now = time.time()
+        expired = [uid for uid, keyword in self.held.items() if now - self._stamp(keyword) >= self.timeout]
+        lost = sorted(set(expired) - set(self.claim(mail, expired))) if expired else []
+        due = {uid: keyword for uid, keyword in self.held.items()
+               if now - self._stamp(keyword) >= CLAIM_RENEW_AFTER_SEC}
+        if not due:
+            return lost
+        keyword = self._new_keyword()
+        mail.uid("STORE", uid_set(due), "+FLAGS.SILENT", f"({keyword})")
+        items = self._fetch_flags(mail, list(due))
+        stale, dropped = [], []
+        for uid, old in due.items():
+            flags = items.get(uid, {}).get("FLAGS")
+            claims = self._claims(flags)
+            if flags is not None and "\\Seen" not in flags and claims and claims[0][1] == self.worker_id:
+                self.held[uid] = keyword
+                stale.append((uid, old))
+                continue
+            del self.held[uid]
+            if flags is not None:
+                stale += [(uid, old), (uid, keyword)]
+                dropped.append(uid)
+        if stale:
+            self._remove_keywords(mail, stale)
+        metrics.inc("claims_renewed", len(due) - len(dropped))
+        if dropped:
+            metrics.inc("claims_lost", len(dropped))
+            logging.warning(f"{len(dropped)} maili przeczytała lub przejęła inna replika: {uid_set(dropped)}.")
+        return lost + dropped
 
-# --- Główna pętla agenta ---
+    def release(self, mail, uids):
+        """Usuwa nasze słowa kluczowe z obsłużonych (już przeczytanych) maili."""
+        self._remove_keywords(mail, [(uid, self.held.pop(uid)) for uid in uids if uid in self.held])
 
-# ... (cały kod agenta) ...
+def coordinate(mail, shard, uids):
+    """Zostawia z listy tylko maile, które może obsłużyć ta replika (COORDINATION).
 
-# --- Główna pętla agenta ---
-if __name__ == "__main__":
-    logging.info("Agent AI startuje...")
-    logging.info("Sprawdzanie poczty będzie powtarzane co 15 sekund.")
-    
-    while True:
-        try:
-            check_emails()
-        except Exception as e:
-            logging.critical(f"Krytyczny błąd w głównej pętli: {e}", exc_info=True)
-        
-        logging.info(f"Odpoczywam przez 15 sekund...")
-        time.sleep(15) # Ustawiamy interwał na 15 sekund
+    W trybie "claim" odnawia nasze rezerwacje i dokłada maile do przejęcia,
+    ale niczego nowego nie rezerwuje - to robi claim_batch, partia po partii.
+    """
+    if COORDINATION == "modulo":
+        return [uid for uid in uids if uid % WORKER_COUNT == WORKER_INDEX]
+    if COORDINATION == "claim":
+        renew_claims(mail, shard)
+        known = set(uids)
+        due = [uid for uid in shard.claims.reclaim_due(mail, shard.checkpoint) if uid not in known]
+        shard.claims.reclaimable.update(due)
+        return uids + due
+    return uids
+
+def renew_claims(mail, shard):
+    """Odnawia rezerwacje sharda; maili przejętych przez inną replikę przestajemy pilnować."""
+    for uid in shard.claims.renew(mail):
+        shard.checkpoint.forget(uid)
+
+def claim_batch(mail, shard, uids):
+    """Tryb "claim": rezerwuje partię `uids` tuż przed pobraniem; zwraca UID do obsłużenia."""
+    checkpoint, claims = shard.checkpoint, shard.claims
+    renew_claims(mail, shard)
+    claimed = claims.claim(mail, uids, reclaim=claims.reclaimable)
+    claims.reclaimable.difference_update(uids)
+    # Maili przejętych przez inną replikę nie ponawiamy - nie mogą też
+    # blokować punktu kontrolnego ani trzymać pętli IDLE w trybie "zajęty"
+    for uid in uids:
+        if uid in checkpoint.failed and uid not in claimed:
+            checkpoint.forget(uid)
+    return claimed
+
+# --- Konta i skrzynki (shardy) ---
+
+class Account:
+    """Konto pocztowe: adres, dane logowania oraz pula SMTP i skrzynka nadawcza,
+    współdzielone przez wszystkie obsługiwane foldery tego konta."""
+
+    def __init__(self, name, address, password, imap_server=IMAP_SERVER, smtp_server=SMTP_SERVER,
+                 smtp_port=SMTP_PORT, smtp_pool=None, outbox=None):
+        self.name = name
+        self.address = address
+        self.password = password
+        self.imap_server = imap_server
+        self.smtp_pool = smtp_pool or SmtpPool(smtp_server, smtp_port, address, password)
+        safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        self.outbox = outbox or Outbox(os.path.join(STATE_DIR, f"outbox_{safe_name}.sqlite3"), self.smtp_pool)
+
+class Shard:
+    """Jeden folder jednego konta - własna sesja IMAP, punkt kontrolny i pętla pobierania.
+
+    Gemini, limity zapytań, bufory i pula wątków potoku są wspólne dla wszystkich shardów.
+    """
+
+    def __init__(self, account, mailbox, session=None, checkpoint=None):
+        self.name = f"{account.name}/{mailbox}"
+        self.account = account
+        self.mailbox = mailbox
+        self.session = session or ImapSession(account.imap_server, account.address, account.password, mailbox)
+        self.checkpoint = checkpoint or SyncCheckpoint(checkpoint_path(account.address, mailbox))
+        self.claims = MessageClaims()
+
+default_account = Account(EMAIL_ADDRESS, EMAIL_ADDRESS, EMAIL_PASSWORD, smtp_pool=smtp_pool, outbox=outbox)
+default_shard = Shard(default_account, "inbox", imap_session, sync_checkpoint)
+# Obsługiwane skrzynki: nazwa -> Shard (przy ACCOUNTS_FILE zastępowane przez load_shards)
+shards = {default_shard.name: default_shard}
+
+def load_shards(path=ACCOUNTS_FILE):
+    """Wczytuje konta i foldery z pliku JSON, np.:
+
+        [{"name": "pomoc", "email": "pomoc@firma.pl", "password_env": "POMOC_PASSWORD",
+          "mailboxes": ["inbox", "Zgłoszenia"]}]
+
+    Opcjonalnie: "password" (zamiast "password_env"), "imap_server",
+    "smtp_server", "smtp_port". Rzuca wyjątek przy błędnej konfiguracji.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    loaded = {}
+    for entry in config:
+        password = entry.get("password") or os.environ[entry["password_env"]]
+        account = Account(entry.get("name", entry["email"]), entry["email"], password,
+                          imap_server=entry.get("imap_server", IMAP_SERVER),
+                          smtp_server=entry.get("smtp_server", SMTP_SERVER),
+                          smtp_port=int(entry.get("smtp_port", SMTP_PORT)))
+        for mailbox in entry.get("mailboxes", ["inbox"]):
+            shard = Shard(account, mailbox)
+            loaded[shard.name] = shard
+    if not loaded:
+        raise ValueError(f"Brak kont w pliku {path}")
+    shards.clear()
+    shards.update(loaded)
+    logging.info(f"Wczytano {len(loaded)} skrzynek: {', '.join(loaded)}")
+
+def shard_for(record):
+    """Shard, z którego pochodzi mail."""
+    return shards.get(record.shard, default_shard)
+
+def accounts():
+    """Konta obsługiwanych shardów (bez powtórzeń)."""
+    return list({id(shard.account): shard.account for shard in shards.values()}.values())
+
+def _uid_search(mail, *criteria):
+    """Wykonuje UID SEARCH i zwraca posortowaną listę UID (int)."""
+    status, data = mail.uid("SEARCH", None, *criteria)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID SEARCH {criteria} nie powiodło się")
+    return sorted(int(uid) for uid in data[0].split())
+
+def needs_resync(session, checkpoint):
+    """Czy zapisany punkt kontrolny nie pasuje do bieżącego UIDVALIDITY skrzynki."""
+    return SYNC_MODE == "uid" and (session.uidvalidity is None or checkpoint.uidvalidity != session.uidvalidity)
+
+def find_new_uids(mail, session, checkpoint):
+    """Zwraca (lista UID do przetworzenia, początek nowej serii UID albo None).
+
+    Normalnie pyta tylko o `UID n+1:*`. Gdy UIDVALIDITY się zmieniło (lub nie
+    ma jeszcze punktu kontrolnego), wykonuje pełną resynchronizację: bierze
+    wszystkie nieprzeczytane wiadomości i zaczyna nową serię UID za najwyższym
+    UID - nie-None drugi element oznacza resynchronizację.
+    """
+    if SYNC_MODE != "uid":
+        return _uid_search(mail, "UNSEEN"), None
+
+    if needs_resync(session, checkpoint):
+        logging.warning(f"UIDVALIDITY zmienione ({checkpoint.uidvalidity} -> {session.uidvalidity}) - pełna resynchronizacja.")
+        # Najpierw najwyższy UID: mail, który przyjdzie między wyszukiwaniami,
+        # trafi do UNSEEN albo za początek nowej serii - nigdy pomiędzy
+        highest = _uid_search(mail, "UID", "*")
+        uids = _uid_search(mail, "UNSEEN")
+        return uids, max(highest + uids + [0])
+
+    # "n+1:*" zawsze zwraca co najmniej ostatnią wiadomość, więc filtrujemy
+    uids = _uid_search(mail, "UID", f"{checkpoint.last_uid + 1}:*")
+    return [uid for uid in uids if uid > checkpoint.last_uid], None
+
+@dataclass
+class EmailRecord:
+    """Zwięzły opis wiadomości - tylko to, czego agent potrzebuje do odpowiedzi."""
+    uid: int
+    sender: str
+    subject: str
+    message_id: Optional[str]
+    prompt: Optional[str]
+    in_reply_to: Optional[str] = None
+    references: Optional[str] = None
+    skip_reason: Optional[str] = None
+    shard: str = ""  # nazwa skrzynki (konto/folder), z której pochodzi mail
+    thread_id: Optional[str] = None  # ustawiane przy generowaniu, gdy prowadzimy historię
+
+def record_from_message(msg, uid, prompt=None):
+    """Buduje EmailRecord z nagłówków wiadomości (prompt z treści, jeśli nie podano)."""
+    if prompt is None:
+        prompt = parse_email_body(msg)
+    return EmailRecord(
+        uid=uid,
+        sender=parseaddr(msg['From'] or "")[1], # Czysty adres e-mail nadawcy
+        subject=decode_subject(msg['Subject'] or ""),
+        message_id=msg['Message-ID'], # Ważne dla odpowiedzi w wątku
+        prompt=prompt,
+        in_reply_to=msg['In-Reply-To'],
+        references=msg['References'],
+    )
+
+def prepare_prompt(record):
+    """Zwraca prompt do wysłania do Gemini albo None, gdy maila nie obsługujemy."""
+    mail_id = record.uid
+
+    # --- GŁÓWNA LOGIKA AGENTA ---
+
+    # 1. Sprawdź, czy to nie jest mail od nas samych, auto-odpowiedź itp. (ważne!)
+    if record.skip_reason:
+        logging.info(f"Pominięto maila ID: {mail_id} ({record.skip_reason}).")
+        return None
+
+    logging.info(f"Przetwarzam maila od: {record.sender}, Temat: {record.subject}")
+
+    # 2. Prompt został już wyciągnięty z treści przy pobieraniu
+    prompt = record.prompt
+
+    if not prompt:
+        logging.warning(f"Nie znaleziono treści (text/plain ani text/html) w mailu ID: {mail_id}.")
+        # I tak oznaczamy jako przeczytany
+        return None
+
+    prompt = prompt.strip()
+    if PROMPT_STRIP_QUOTES:
+        cleaned = strip_quoted_text(prompt)
+        before, after = estimate_prompt_tokens(prompt), estimate_prompt_tokens(cleaned)
+        if after < before:
+            metrics.inc("prompt_tokens_saved", before - after)
+            logging.info(f"Prompt maila ID: {mail_id}: ~{before} -> ~{after} tokenów po usunięciu cytatów i stopek.")
+        prompt = cleaned
+    return prompt
+
+# --- Przygotowanie promptu (cytaty, podpisy, limit tokenów) ---
+
+# Nagłówek cytowanej odpowiedzi: "On ... wrote:", "W dniu ... napisał(a):" itp.
+_REPLY_HEADER_RE = re.compile(
+    r"^(On\s.+\swrote:|W dniu\s.+\snapisał(\(a\)|a)?:|Dnia\s.+\snapisał(\(a\)|a)?:"
+    r"|Am\s.+\sschrieb.*:|Le\s.+\sa écrit\s?:)$",
+    re.IGNORECASE)
+# Separator Outlooka/Thunderbirda - pod nim cytat bez znaków ">"
+_ORIGINAL_MESSAGE_RE = re.compile(r"^-{2,}\s*(Original Message|Wiadomość oryginalna)\s*-{2,}$", re.IGNORECASE)
+# Blok nagłówków Outlooka: "From: ..." / "Od: ..", a zaraz potem "Sent: ..." / "Wysłano: ..."
+_OUTLOOK_FROM_RE = re.compile(r"^(From|Od):\s", re.IGNORECASE)
+_OUTLOOK_SENT_RE = re.compile(r"^(Sent|Date|Wysłano|Wysłane|Data):\s", re.IGNORECASE)
+# Stopka "wysłane z telefonu" - cała linia, najwyżej kilka słów nazwy urządzenia
+_MOBILE_FOOTER_RE = re.compile(
+    r"^(Sent from my|Sent from (Mail|Outlook|Yahoo Mail) for|Get Outlook for|Wysłane z (mojego|mojej)|Wysłano z (mojego|mojej))"
+    r" [\w'-]+( [\w'-]+){0,3}[.!]?$",
+    re.IGNORECASE)
+# Początek stopki prawnej - akapit, który ciągnie się do końca maila
+_LEGAL_NOTICE_RE = re.compile(
+    r"^((CONFIDENTIALITY NOTICE|DISCLAIMER|KLAUZULA POUFNOŚCI)\s*(:|$)"
+    r"|This (e-?mail|message)( and any attachments)? (is|are|may be|contains?) (strictly )?(confidential|privileged)"
+    r"|This (e-?mail|message)( and any attachments)? (is|are) intended (solely|only|exclusively) for the (use of the )?"
+    r"(addressee|recipient|individual|person|named)"
+    r"|(Ta|Niniejsza) wiadomość.{0,80}(jest poufn|zawiera informacje poufne|przeznaczona (jest )?wyłącznie dla (adresat|odbiorc)))",
+    re.IGNORECASE)
+# Pod nagłówkiem "On ... wrote:" co najmniej tyle niepustych linii musi być cytatem ("> ...")
+_QUOTED_TAIL_RATIO = 0.8
+# Podpis ("--") jest usuwany tylko, gdy stoi na końcu - pod nim najwyżej tyle linii
+_SIGNATURE_MAX_LINES = 8
+
+def _nonblank(lines):
+    return [line for line in lines if line.strip()]
+
+def _quoted_tail(lines):
+    """Czy linie (do końca maila) to w przeważającej części cytat "> ..."."""
+    tail = _nonblank(lines)
+    quoted = sum(1 for line in tail if line.lstrip().startswith(">"))
+    return bool(tail) and quoted >= len(tail) * _QUOTED_TAIL_RATIO
+
+def _quote_block_start(lines):
+    """Indeks, od którego do końca maila ciągnie się cytowana historia (albo None)."""
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if _ORIGINAL_MESSAGE_RE.match(stripped):
+            return i
+        if _OUTLOOK_FROM_RE.match(stripped) and i + 1 < len(lines) and _OUTLOOK_SENT_RE.match(lines[i + 1].strip()):
+            return i
+        if _REPLY_HEADER_RE.match(stripped) and _quoted_tail(lines[i + 1:]):
+            return i
+        # Gmail łamie "On ... wrote:" na dwie linie
+        if i + 1 < len(lines) and _REPLY_HEADER_RE.match(f"{stripped} {lines[i + 1].strip()}") \
+                and _quoted_tail(lines[i + 2:]):
+            return i
+    return None
+
+def _footer_start(lines):
+    """Indeks, od którego do końca maila są już tylko stopki (albo None).
+
+    Stopka "wysłane z telefonu" to jedna linia; stopka prawna to cały akapit.
+    Jakakolwiek inna treść za nimi oznacza, że to nie były stopki.
+    """
+    start, legal, new_paragraph = None, False, True
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped:
+            new_paragraph = True
+            continue
+        if _MOBILE_FOOTER_RE.match(stripped):
+            start, legal = i if start is None else start, False
+        elif _LEGAL_NOTICE_RE.match(stripped):
+            start, legal = i if start is None else start, True
+        elif not legal or new_paragraph:
+            start, legal = None, False
+        new_paragraph = False
+    return start
+
+def strip_quoted_text(text):
+    """Usuwa z końca treści cytowaną historię, podpis i stopki.
+
+    Cytat jest usuwany tylko wtedy, gdy ciągnie się do końca maila: nagłówek
+    "On ... wrote:" z liniami "> ..." pod spodem, blok nagłówków Outlooka
+    albo same linie "> ..." na końcu. Cytaty wplecione w odpowiedź i zdania
+    w rodzaju "W poniedziałek szef napisał:" zostają. Stopki usuwamy tylko,
+    gdy za nimi nie ma już innej treści. Jeśli po oczyszczeniu nic nie
+    zostaje (cały mail był cytatem), zwraca oryginał.
+    """
+    lines = text.splitlines()
+    start = _quote_block_start(lines)
+    if start is not None:
+        lines = lines[:start]
+    while lines and (not lines[-1].strip() or lines[-1].lstrip().startswith(">")):
+        lines.pop()
+
+    footer = _footer_start(lines)
+    if footer is not None:
+        lines = lines[:footer]
+    for i, line in enumerate(lines):
+        if line.rstrip() == "--" and len(_nonblank(lines[i + 1:])) <= _SIGNATURE_MAX_LINES:
+            # Separator podpisu "-- " - jeśli pod nim jest już tylko krótki podpis
+            lines = lines[:i]
+            break
+
+    cleaned = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+    return cleaned or text
+
+# Dopisywane do promptu, który przycięto do limitu tokenów
+TRUNCATED_PROMPT_NOTE = "\n\n[Dalsza część wiadomości została pominięta.]"
+
+def _truncate_to_budget(prompt, tokens):
+    """Przycina prompt proporcjonalnie, by zmieścił się w PROMPT_TOKEN_BUDGET."""
+    if tokens <= PROMPT_TOKEN_BUDGET:
+        return prompt
+    keep = int(len(prompt) * PROMPT_TOKEN_BUDGET / tokens * 0.95)
+    metrics.inc("prompt_tokens_saved", tokens - PROMPT_TOKEN_BUDGET)
+    metrics.inc("prompts_truncated")
+    logging.warning(f"Prompt ma {tokens} tokenów (limit {PROMPT_TOKEN_BUDGET}) - przycinam do {keep} znaków.")
+    return prompt[:keep] + TRUNCATED_PROMPT_NOTE
+
+def fit_token_budget(prompt):
+    """Pilnuje limitu tokenów; licznik modelu pytamy tylko, gdy szacunek jest blisko limitu."""
+    estimate = estimate_prompt_tokens(prompt)
+    if estimate < PROMPT_TOKEN_BUDGET * 0.8:
+        return prompt
+    try:
+        rate_limiter.acquire(GEMINI_MODEL, 0)
+        tokens = gemini_client.model().count_tokens(prompt).total_tokens
+    except Exception as e:
+        logging.warning(f"Nie udało się policzyć tokenów ({e}) - używam szacunku.")
+        tokens = estimate
+    return _truncate_to_budget(prompt, tokens)
+
+async def fit_token_budget_async(prompt):
+    """Asynchroniczna wersja fit_token_budget."""
+    estimate = estimate_prompt_tokens(prompt)
+    if estimate < PROMPT_TOKEN_BUDGET * 0.8:
+        return prompt
+    try:
+        await rate_limiter.acquire_async(GEMINI_MODEL, 0)
+        tokens = (await gemini_client.model().count_tokens_async(prompt)).total_tokens
+    except Exception as e:
+        logging.warning(f"Nie udało się policzyć tokenów ({e}) - używam szacunku.")
+        tokens = estimate
+    return _truncate_to_budget(prompt, tokens)
+
+# --- Bufor odpowiedzi ---
+
+def normalize_prompt(prompt):
+    """Normalizuje prompt do porównań: bez różnic w wielkości liter i białych znakach."""
+    return " ".join(prompt.split()).casefold()
+
+def prompt_cache_key(prompt, model=GEMINI_MODEL, generation_config=None):
+    """Klucz bufora: skrót znormalizowanego promptu, modelu i konfiguracji generowania."""
+    config = json.dumps(generation_config, sort_keys=True, default=str)
+    data = f"{model}\0{config}\0{normalize_prompt(prompt)}"
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Bufor odpowiedzi dla identycznych (po normalizacji) promptów.
+
+    Najczęściej używane wpisy trzymamy w pamięci (LRU), wszystkie - w SQLite
+    na dysku, z czasem ważności (TTL) i limitem liczby wpisów.
+    """
+
+    def __init__(self, path, memory_items=RESPONSE_CACHE_MEMORY_ITEMS,
+                 max_items=RESPONSE_CACHE_MAX_ITEMS, ttl=RESPONSE_CACHE_TTL_SEC):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.memory_items = memory_items
+        self.max_items = max_items
+        self.ttl = ttl
+        self._memory = OrderedDict()  # klucz -> (odpowiedź, wygasa)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                answer TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def _remember(self, key, answer, expires):
+        self._memory[key] = (answer, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Zwraca zapisaną odpowiedź albo None (liczy trafienia i chybienia)."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[1] > now:
+                self._memory.move_to_end(key)
+                metrics.inc("cache_hits_memory")
+                return entry[0]
+            row = self._db.execute("SELECT answer, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and row[1] > now:
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._remember(key, row[0], row[1])
+                metrics.inc("cache_hits_disk")
+                return row[0]
+            self._memory.pop(key, None)
+            metrics.inc("cache_misses")
+            return None
+
+    def put(self, key, answer):
+        """Zapisuje odpowiedź; co jakiś czas usuwa wpisy przeterminowane i nadmiarowe."""
+        now = time.time()
+        expires = now + self.ttl
+        with self._lock:
+            self._remember(key, answer, expires)
+            self._db.execute("INSERT OR REPLACE INTO responses (key, answer, expires, last_access) VALUES (?, ?, ?, ?)",
+                             (key, answer, expires, now))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_items:
+            # Usuwamy najdawniej używane wpisy
+            self._db.execute("DELETE FROM responses WHERE key IN "
+                             "(SELECT key FROM responses ORDER BY last_access LIMIT ?)", (count - self.max_items,))
+
+response_cache = ResponseCache(os.path.join(STATE_DIR, "responses.sqlite3")) if RESPONSE_CACHE_ENABLED else None
+
+# --- Bufor semantyczny (podobne prompty) ---
+
+class SentenceTransformerEmbedder:
+    """Embedder oparty o mały lokalny model sentence-transformers (opcjonalna zależność)."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, texts):
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+class SemanticCache:
+    """Bufor odpowiedzi dla promptów podobnych znaczeniowo.
+
+    Wektory (znormalizowane, float32) leżą w pliku mapowanym w pamięci
+    (np.memmap), więc przetrwają restart; odpowiedzi i czasy użycia - w SQLite.
+    Podobieństwo liczymy jednym mnożeniem macierzy przez wektor (cosinus).
+    Po zapełnieniu usuwany jest najdawniej używany wpis. Embedder jest
+    dowolną funkcją list[str] -> macierz, więc w testach można podać atrapę.
+    """
+
+    def __init__(self, directory, embedder, capacity=SEMANTIC_CACHE_CAPACITY,
+                 threshold=SEMANTIC_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL_SEC):
+        os.makedirs(directory, exist_ok=True)
+        self.embedder = embedder
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        # Wymiar w nazwie pliku - zmiana embeddera zaczyna nowy indeks
+        vectors_path = os.path.join(directory, f"semantic_{embedder.dim}.f32")
+        mode = "r+" if os.path.exists(vectors_path) else "w+"
+        self._vectors = np.memmap(vectors_path, dtype=np.float32, mode=mode, shape=(capacity, embedder.dim))
+
+        self._db = sqlite3.connect(os.path.join(directory, f"semantic_{embedder.dim}.sqlite3"),
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                slot INTEGER PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+
+        # W pamięci: które sloty są zajęte i do jakiego modelu/konfiguracji należą
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_access = np.zeros(capacity, dtype=np.float64)
+        self._namespace = [None] * capacity
+        for slot, namespace, expires, last_access in self._db.execute(
+                "SELECT slot, namespace, expires, last_access FROM entries WHERE slot < ?", (capacity,)):
+            self._valid[slot] = True
+            self._expires[slot] = expires
+            self._last_access[slot] = last_access
+            self._namespace[slot] = namespace
+
+    def _candidates(self, namespace, now):
+        mask = self._valid & (self._expires > now)
+        return [int(slot) for slot in np.flatnonzero(mask) if self._namespace[slot] == namespace]
+
+    def lookup(self, prompt, namespace):
+        """Zwraca (odpowiedź, podobieństwo) najbliższego promptu powyżej progu albo (None, najlepsze podobieństwo)."""
+        vector = self.embedder([normalize_prompt(prompt)])[0]
+        now = time.time()
+        with self._lock:
+            slots = self._candidates(namespace, now)
+            if not slots:
+                return None, 0.0
+            similarities = self._vectors[slots] @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                return None, similarity
+            slot = slots[best]
+            row = self._db.execute("SELECT answer FROM entries WHERE slot = ?", (slot,)).fetchone()
+            if row is None:
+                return None, similarity
+            self._last_access[slot] = now
+            self._db.execute("UPDATE entries SET last_access = ? WHERE slot = ?", (now, slot))
+            return row[0], similarity
+
+    def put(self, prompt, namespace, answer):
+        """Dodaje prompt i odpowiedź; przy pełnym indeksie nadpisuje najdawniej używany wpis."""
+        vector = self.embedder([normalize_prompt(prompt)])[0]
+        now = time.time()
+        with self._lock:
+            free = np.flatnonzero(~self._valid | (self._expires <= now))
+            slot = int(free[0]) if len(free) else int(np.argmin(self._last_access))
+            # Najpierw unieważniamy stary wpis - awaria po zapisie wektora nie
+            # może połączyć nowego wektora ze starą odpowiedzią
+            self._db.execute("DELETE FROM entries WHERE slot = ?", (slot,))
+            self._valid[slot] = False
+            self._vectors[slot] = vector
+            self._vectors.flush()
+            self._db.execute("INSERT OR REPLACE INTO entries (slot, namespace, answer, expires, last_access) "
+                             "VALUES (?, ?, ?, ?, ?)", (slot, namespace, answer, now + self.ttl, now))
+            self._valid[slot] = True
+            self._expires[slot] = now + self.ttl
+            self._last_access[slot] = now
+            self._namespace[slot] = namespace
+
+def _create_semantic_cache():
+    """Tworzy bufor semantyczny z modelem sentence-transformers; bez modelu zwraca None."""
+    if not SEMANTIC_CACHE_MODEL:
+        logging.warning("SEMANTIC_CACHE_ENABLED=1 bez SEMANTIC_CACHE_MODEL - bufor semantyczny wyłączony.")
+        return None
+    try:
+        embedder = SentenceTransformerEmbedder(SEMANTIC_CACHE_MODEL)
+    except Exception as e:
+        logging.warning(f"Nie udało się wczytać modelu {SEMANTIC_CACHE_MODEL} ({e}) - bufor semantyczny wyłączony.")
+        return None
+    return SemanticCache(os.path.join(STATE_DIR, "semantic"), embedder)
+
+semantic_cache = _create_semantic_cache() if SEMANTIC_CACHE_ENABLED else None
+
+def cached_answer(record, prompt):
+    """Zwraca odpowiedź z bufora (albo None), z pominięciem nadawców, którzy z niego zrezygnowali."""
+    if record.sender.lower() in RESPONSE_CACHE_OPTOUT:
+        return None
+    answer = response_cache.get(prompt_cache_key(prompt)) if response_cache else None
+    if answer:
+        logging.info(f"Odpowiedź dla maila ID: {record.uid} wzięta z bufora.")
+        return answer
+
+    if semantic_cache is not None:
+        answer, similarity = semantic_cache.lookup(prompt, prompt_cache_key(""))
+        if answer:
+            metrics.inc("semantic_cache_hits")
+            logging.info(f"Odpowiedź dla maila ID: {record.uid} wzięta z bufora semantycznego (podobieństwo {similarity:.3f}).")
+        else:
+            metrics.inc("semantic_cache_misses")
+    return answer
+
+def remember_answer(record, prompt, answer):
+    """Zapisuje świeżą odpowiedź Gemini w buforach."""
+    if record.sender.lower() in RESPONSE_CACHE_OPTOUT:
+        return
+    if answer and answer != BLOCKED_ANSWER:
+        if response_cache is not None:
+            response_cache.put(prompt_cache_key(prompt), answer)
+        if semantic_cache is not None:
+            # Przestrzeń nazw = model i konfiguracja (klucz pustego promptu)
+            semantic_cache.put(prompt, prompt_cache_key(""), answer)
+
+# --- Historia rozmów (wątki po Message-ID / References) ---
+
+_MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+def message_ids(header):
+    """Lista identyfikatorów <...> z nagłówka References / In-Reply-To."""
+    return _MESSAGE_ID_RE.findall(header or "")
+
+class ConversationStore:
+    """Zwięzła historia wątków w SQLite: jedna tura (oczyszczony prompt albo
+    nasza odpowiedź) na Message-ID.
+
+    Gdy ktoś odpisze na naszą odpowiedź, wątek odnajdujemy po References /
+    In-Reply-To, a wcześniejsze tury wysyłamy do Gemini jako rozmowę - bez
+    ponownego parsowania cytowanej historii z treści maila. Każda tura należy
+    do pary (nasze konto, korespondent): ktoś, kto odpisze na przekazaną
+    dalej kopię, nie zobaczy cudzej historii.
+    """
+
+    def __init__(self, path, ttl=CONVERSATION_TTL_SEC):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(turns)")}
+        if columns and "account" not in columns:
+            # Tur bez konta i nadawcy nie da się bezpiecznie przypisać - zaczynamy od nowa
+            logging.warning("Historia rozmów w starym formacie (bez konta i nadawcy) - usuwam ją.")
+            self._db.execute("DROP TABLE turns")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                account TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                thread_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (account, message_id)
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_thread ON turns (thread_id, created)")
+
+    def thread_for(self, record, account):
+        """Zwraca id wątku, do którego należy mail (nowy wątek = jego własny Message-ID).
+
+        Brane są pod uwagę tylko tury tego konta i tego samego nadawcy.
+        """
+        refs = message_ids(record.references) + message_ids(record.in_reply_to)
+        if refs:
+            placeholders = ",".join("?" * len(refs))
+            with self._lock:
+                row = self._db.execute(f"SELECT thread_id FROM turns WHERE account = ? AND sender = ? "
+                                       f"AND message_id IN ({placeholders}) ORDER BY created DESC LIMIT 1",
+                                       [account, record.sender.lower(), *refs]).fetchone()
+            if row:
+                return row[0]
+        return record.message_id
+
+    def history(self, thread_id, exclude_id, account, sender, budget=CONVERSATION_TOKEN_BUDGET):
+        """Najnowsze tury wątku (tego konta i nadawcy) w limicie tokenów, jako `contents` dla Gemini."""
+        with self._lock:
+            rows = self._db.execute("SELECT role, text, tokens FROM turns WHERE thread_id = ? AND account = ? "
+                                    "AND sender = ? AND message_id != ? ORDER BY created DESC",
+                                    (thread_id, account, sender.lower(), exclude_id)).fetchall()
+        turns, used = [], 0
+        for role, text, tokens in rows:
+            if used + tokens > budget:
+                break  # Starsze tury pomijamy
+            used += tokens
+            turns.append((role, text))
+        turns.reverse()
+        # Rozmowa musi zaczynać się od użytkownika, a role muszą się przeplatać
+        while turns and turns[0][0] != "user":
+            turns.pop(0)
+        contents = []
+        for role, text in turns:
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"][0] += "\n\n" + text
+            else:
+                contents.append({"role": role, "parts": [text]})
+        return contents
+
+    def add_turn(self, thread_id, message_id, role, text, account, sender):
+        """Zapisuje turę rozmowy konta `account` z `sender` (powtórny zapis tego samego Message-ID ją nadpisuje)."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO turns (account, sender, message_id, thread_id, role, text, "
+                             "tokens, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (account, sender.lower(), message_id, thread_id, role, text,
+                              estimate_prompt_tokens(text), now))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                # Usuwamy całe wątki, w których od dawna nic się nie działo
+                self._db.execute("DELETE FROM turns WHERE thread_id IN "
+                                 "(SELECT thread_id FROM turns GROUP BY thread_id HAVING MAX(created) <= ?)",
+                                 (now - self.ttl,))
+
+conversation_store = ConversationStore(os.path.join(STATE_DIR, "conversations.sqlite3")) if CONVERSATION_ENABLED else None
+
+def conversation_contents(record, prompt):
+    """Dołącza prompt do historii wątku; zwraca listę tur albo None dla nowego wątku."""
+    if conversation_store is None or not record.message_id:
+        return None
+    account = shard_for(record).account.address.lower()
+    record.thread_id = conversation_store.thread_for(record, account)
+    history = conversation_store.history(record.thread_id, record.message_id, account, record.sender)
+    conversation_store.add_turn(record.thread_id, record.message_id, "user", prompt, account, record.sender)
+    if not history:
+        return None
+    logging.info(f"Mail ID: {record.uid} kontynuuje wątek - dołączam {len(history)} wcześniejszych tur.")
+    metrics.inc("conversation_followups")
+    if history[-1]["role"] == "user":
+        # Poprzednie pytanie zostało bez odpowiedzi - łączymy je z bieżącym
+        history[-1]["parts"][0] += "\n\n" + prompt
+        return history
+    return history + [{"role": "user", "parts": [prompt]}]
+
+# --- Rejestr przetworzonych wiadomości (idempotencja) ---
+
+class BloomFilter:
+    """Filtr Blooma o stałym rozmiarze - "na pewno nie było" bez zaglądania do bazy."""
+
+    def __init__(self, capacity, error_rate):
+        bits = max(8, int(-capacity * np.log(error_rate) / np.log(2) ** 2))
+        self.hashes = max(1, round(bits / capacity * np.log(2)))
+        self.size = bits
+        self._bits = np.zeros((bits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, digest):
+        # Podwójne haszowanie z jednego skrótu SHA-256
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+# Kolejne etapy obsługi maila - stan w rejestrze tylko rośnie
+LEDGER_STATES = ("fetched", "generated", "sent", "flagged")
+
+class ProcessedLedger:
+    """Trwały rejestr obsłużonych maili (SQLite WAL) ze stanami fetched ->
+    generated -> sent -> flagged.
+
+    Kluczem jest skrót konta i Message-ID (albo treści, gdy go brak) - 16
+    bajtów na wpis; mail wysłany do dwóch naszych kont dostaje dwie
+    odpowiedzi. Ten sam Message-ID z inną treścią to inna wiadomość. Przed
+    bazą stoi filtr Blooma o stałym rozmiarze, więc dla nowych maili
+    (zdecydowana większość) nie ma nawet zapytania SQL. Odpowiedź
+    Gemini trzymamy tylko między "generated" a "sent", by po awarii wysłać ją
+    bez ponownego (płatnego) generowania.
+    """
+
+    def __init__(self, path, capacity=LEDGER_BLOOM_CAPACITY, error_rate=LEDGER_BLOOM_ERROR_RATE, ttl=LEDGER_TTL_SEC):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._uids = {}  # (shard, UID) -> klucz, dla maili czekających na flagę \\Seen
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                key BLOB PRIMARY KEY,
+                state TEXT NOT NULL,
+                content_hash BLOB,
+                answer TEXT,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID""")
+        self.bloom = BloomFilter(capacity, error_rate)
+        for (key,) in self._db.execute("SELECT key FROM ledger"):
+            self.bloom.add(key)
+
+    @staticmethod
+    def key_for(record):
+        """Klucz rejestru (konto + Message-ID albo treść) i skrót treści wiadomości."""
+        account = shard_for(record).account.address.lower()
+        content = f"{account}\0{record.sender}\0{record.subject}\0{record.prompt}"
+        content = hashlib.sha256(content.encode("utf-8")).digest()
+        if record.message_id:
+            return hashlib.sha256(f"{account}\0{record.message_id.strip()}".encode("utf-8")).digest()[:16], content[:16]
+        return content[:16], content[:16]
+
+    def _entry(self, record):
+        """Zwraca (klucz, skrót treści, stan, odpowiedź, czy Message-ID powtórzony); pod blokadą.
+
+        Gdy pod tym Message-ID zapisano inną treść (klient, który powtarza
+        Message-ID), mail dostaje klucz oparty na samej treści.
+        """
+        key, content_hash = self.key_for(record)
+        if key not in self.bloom:
+            return key, content_hash, None, None, False
+        row = self._db.execute("SELECT state, answer, content_hash FROM ledger WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            metrics.inc("ledger_bloom_false_positives")
+            return key, content_hash, None, None, False
+        state, answer, stored_hash = row
+        if key == content_hash or stored_hash is None or stored_hash == content_hash:
+            return key, content_hash, state, answer, False
+        row = None
+        if content_hash in self.bloom:
+            row = self._db.execute("SELECT state, answer FROM ledger WHERE key = ?", (content_hash,)).fetchone()
+        return (content_hash, content_hash, *(row or (None, None)), True)
+
+    def lookup(self, record):
+        """Zwraca (stan, zapisana odpowiedź) albo (None, None) dla nieznanego maila."""
+        with self._lock:
+            _, _, state, answer, reused = self._entry(record)
+        if reused and state is None:
+            logging.warning(f"Mail ID: {record.uid} ma Message-ID {record.message_id} innej, już obsłużonej "
+                            "wiadomości - traktuję go jako nowy.")
+            metrics.inc("ledger_message_id_reused")
+        return state, answer
+
+    def mark(self, record, state, answer=None):
+        """Przesuwa mail do stanu `state` (nigdy wstecz)."""
+        now = time.time()
+        with self._lock:
+            key, content_hash, current, _, _ = self._entry(record)
+            if current and LEDGER_STATES.index(current) >= LEDGER_STATES.index(state):
+                return
+            # Odpowiedź jest potrzebna tylko do czasu wysyłki
+            self._db.execute("INSERT OR REPLACE INTO ledger (key, state, content_hash, answer, updated) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, state, content_hash, answer, now))
+            self.bloom.add(key)
+            if state == "flagged":
+                self._uids.pop((record.shard, record.uid), None)
+            else:
+                self._uids[(record.shard, record.uid)] = key
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._db.execute("DELETE FROM ledger WHERE state = 'flagged' AND updated <= ?", (now - self.ttl,))
+
+    def mark_flagged(self, uids, shard=""):
+        """Po udanym UID STORE \\Seen - zamyka obsługę podanych maili."""
+        now = time.time()
+        with self._lock:
+            keys = [self._uids.pop((shard, uid)) for uid in uids if (shard, uid) in self._uids]
+            self._db.executemany("UPDATE ledger SET state = 'flagged', answer = NULL, updated = ? WHERE key = ?",
+                                 [(now, key) for key in keys])
+
+ledger = ProcessedLedger(os.path.join(STATE_DIR, "ledger.sqlite3")) if LEDGER_ENABLED else None
+
+def ledger_check(record):
+    """Sprawdza rejestr przed wywołaniem Gemini.
+
+    Zwraca (obsłużony, odpowiedź): obsłużony=True, gdy odpowiedź już wysłano;
+    odpowiedź - gdy została wygenerowana, ale nie wysłana przed awarią.
+    """
+    if ledger is None:
+        return False, None
+    state, answer = ledger.lookup(record)
+    if state in ("sent", "flagged"):
+        logging.warning(f"Mail ID: {record.uid} ({record.message_id}) ma już wysłaną odpowiedź - pomijam.")
+        metrics.inc("ledger_duplicates")
+        return True, None
+    if state == "generated" and answer:
+        logging.info(f"Mail ID: {record.uid} - używam odpowiedzi wygenerowanej przed restartem.")
+        metrics.inc("ledger_recovered_answers")
+        return False, answer
+    ledger.mark(record, "fetched")
+    return False, None
+
+def generate_answer(record):
+    """Etap LLM: zwraca odpowiedź Gemini dla wiadomości albo None, gdy nie ma czego wysłać."""
+    prompt = prepare_prompt(record)
+    if not prompt:
+        return None
+    handled, answer = ledger_check(record)
+    if handled or answer:
+        return answer
+    prompt = fit_token_budget(prompt)
+    contents = conversation_contents(record, prompt)
+
+    # 3. Wykonaj prompt w Gemini (chyba że znamy już odpowiedź - tylko dla nowych wątków)
+    gemini_answer = cached_answer(record, prompt) if contents is None else None
+    if gemini_answer:
+        return gemini_answer
+
+    logging.info("Wysyłam prompt do Gemini...")
+    gemini_answer = get_gemini_response(contents or prompt)
+    if not gemini_answer:
+        logging.error(f"Nie udało się uzyskać odpowiedzi Gemini dla maila ID: {record.uid}.")
+    if contents is None:
+        remember_answer(record, prompt, gemini_answer)
+    if gemini_answer and ledger is not None:
+        ledger.mark(record, "generated", gemini_answer)
+    return gemini_answer
+
+async def generate_answer_async(record):
+    """Asynchroniczna wersja generate_answer."""
+    prompt = prepare_prompt(record)
+    if not prompt:
+        return None
+    # Rejestr, historia wątku i cache to SQLite/pliki - poza pętlą zdarzeń
+    handled, answer = await asyncio.to_thread(ledger_check, record)
+    if handled or answer:
+        return answer
+    prompt = await fit_token_budget_async(prompt)
+    contents = await asyncio.to_thread(conversation_contents, record, prompt)
+
+    gemini_answer = await asyncio.to_thread(cached_answer, record, prompt) if contents is None else None
+    if gemini_answer:
+        return gemini_answer
+
+    logging.info("Wysyłam prompt do Gemini (async)...")
+    gemini_answer = await get_gemini_response_async(contents or prompt)
+    if not gemini_answer:
+        logging.error(f"Nie udało się uzyskać odpowiedzi Gemini dla maila ID: {record.uid}.")
+    if contents is None:
+        await asyncio.to_thread(remember_answer, record, prompt, gemini_answer)
+    if gemini_answer and ledger is not None:
+        await asyncio.to_thread(ledger.mark, record, "generated", gemini_answer)
+    return gemini_answer
+
+def deliver_answer(record, answer):
+    """Etap wysyłki: odsyła odpowiedź; zwraca True, jeśli się udało."""
+    # 4. Odeślij odpowiedź (z własnym Message-ID, by rozpoznać odpowiedź na nią)
+    account = shard_for(record).account
+    reply_id = new_message_id(account.address)
+    ok = send_reply(record.sender, record.subject, record.message_id, answer,
+                    references=record.references, message_id=reply_id, account=account)
+    if ok and ledger is not None:
+        ledger.mark(record, "sent")
+    if ok and record.thread_id and conversation_store is not None:
+        conversation_store.add_turn(record.thread_id, reply_id, "model", answer,
+                                    account.address.lower(), record.sender)
+    return ok
+
+def process_email(record):
+    """Przetwarza jedną wiadomość po kolei: prompt -> Gemini -> odpowiedź.
+
+    Zwraca True, jeśli wiadomość można zatwierdzić (oznaczyć jako przeczytaną),
+    False przy nieudanej wysyłce lub nieoczekiwanym błędzie i None, gdy trzeba
+    ją odłożyć na później.
+    """
+    try:
+        answer = generate_answer(record)
+        if not answer:
+            return True
+        return deliver_answer(record, answer)
+    except GeminiUnavailable as e:
+        logging.warning(f"Odkładam maila ID: {record.uid} na później: {e}")
+        return None
+    except Exception as e:
+        # UID nie może zostać w in_flight - wróci w kolejnym cyklu
+        logging.error(f"Błąd podczas obsługi maila ID: {record.uid}: {e}", exc_info=True)
+        return False
+
+# --- Potok przetwarzania (pobieranie -> Gemini -> wysyłka) ---
+
+class FairQueue:
+    """Kolejka z osobnym limitem dla każdego klucza (skrzynki), wydawana po kolei (round-robin).
+
+    Zajęta skrzynka blokuje się na własnym limicie i nie wypycha z kolejki
+    pozostałych - każda z oczekujących dostaje swoją turę.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._queues = OrderedDict()  # klucz -> deque, w kolejności obsługi
+        self._cond = threading.Condition()
+
+    def free(self, key):
+        """Ile elementów klucza `key` zmieści się jeszcze bez blokowania."""
+        with self._cond:
+            return self.maxsize - len(self._queues.get(key, ()))
+
+    def put(self, key, item):
+        with self._cond:
+            while len(self._queues.get(key, ())) >= self.maxsize:
+                self._cond.wait()
+            self._queues.setdefault(key, deque()).append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            key, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            if items:
+                self._queues[key] = items  # na koniec - teraz kolej innych skrzynek
+            self._cond.notify_all()
+            return item
+
+class Pipeline:
+    """Etapowe, współbieżne przetwarzanie maili.
+
+    Wątki IMAP (check_emails) wrzucają rekordy do ograniczonej kolejki
+    (z osobnym limitem i równą kolejką dla każdej skrzynki), pula wątków LLM
+    generuje odpowiedzi, a osobny wątek je wysyła. Wynik (uid, ok)
+    wraca do kolejki `done` punktu kontrolnego - flagę \\Seen i punkt kontrolny
+    zatwierdza wątek IMAP dopiero po udanej wysyłce. Pełne kolejki blokują
+    pobieranie (backpressure).
+    """
+
+    def __init__(self, workers=LLM_WORKERS, queue_size=PIPELINE_QUEUE_SIZE):
+        self.llm_queue = FairQueue(queue_size)
+        self.send_queue = queue.Queue(maxsize=queue_size)
+        for i in range(workers):
+            threading.Thread(target=self._llm_worker, name=f"llm-{i}", daemon=True).start()
+        threading.Thread(target=self._sender, name="sender", daemon=True).start()
+
+    def capacity(self, key):
+        """Ile rekordów skrzynki `key` przyjmie teraz submit() bez blokowania."""
+        return self.llm_queue.free(key)
+
+    def submit(self, record, done):
+        """Przekazuje rekord do obsługi; blokuje, gdy kolejka jest pełna."""
+        if record.skip_reason or not record.prompt:
+            # Nie ma czego generować - nie zajmujemy miejsca w kolejce
+            generate_answer(record)
+            done.put((record.uid, True))
+            return
+        self.llm_queue.put(record.shard, (record, done))
+
+    def _llm_worker(self):
+        while True:
+            record, done = self.llm_queue.get()
+            try:
+                answer = generate_answer(record)
+            except GeminiUnavailable as e:
+                logging.warning(f"Odkładam maila ID: {record.uid} na później: {e}")
+                done.put((record.uid, None))
+                continue
+            except Exception as e:
+                # Bez odpowiedzi nie zatwierdzamy - mail wróci (do SEND_MAX_ATTEMPTS prób)
+                logging.error(f"Błąd w wątku Gemini (mail ID: {record.uid}): {e}", exc_info=True)
+                done.put((record.uid, False))
+                continue
+            if answer:
+                self.send_queue.put((record, answer, done))
+            else:
+                done.put((record.uid, True))
+
+    def _sender(self):
+        while True:
+            record, answer, done = self.send_queue.get()
+            try:
+                ok = deliver_answer(record, answer)
+            except Exception as e:
+                logging.error(f"Błąd w wątku wysyłki (mail ID: {record.uid}): {e}", exc_info=True)
+                ok = False
+            done.put((record.uid, ok))
+
+class AsyncPipeline:
+    """Potok oparty o jedną pętlę asyncio - ten sam interfejs co Pipeline.
+
+    Zapytania do Gemini to korutyny (generate_content_async), więc setki z nich
+    mogą czekać jednocześnie bez osobnych wątków. IMAP i SMTP pozostają
+    blokujące (imaplib/smtplib) i działają w wątkach przez asyncio.to_thread.
+    """
+
+    def __init__(self, loop, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        self.loop = loop
+        self.max_in_flight = max_in_flight
+        # Semafor wątkowy - submit() jest wołane z wątku IMAP i blokuje go (backpressure)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        # Każda skrzynka może zająć najwyżej swoją część miejsc - żadna nie zagłodzi innych
+        self.shard_limit = max(1, max_in_flight // max(1, len(shards)))
+        self.shard_slots = {}
+        self._lock = threading.Lock()
+        self._in_flight = Counter()  # skrzynka -> liczba zapytań w locie
+
+    def capacity(self, key):
+        """Ile rekordów skrzynki `key` przyjmie teraz submit() bez blokowania."""
+        with self._lock:
+            return min(self.shard_limit - self._in_flight[key],
+                       self.max_in_flight - sum(self._in_flight.values()))
+
+    def submit(self, record, done):
+        """Przekazuje rekord do pętli asyncio; blokuje, gdy w locie jest za dużo zapytań."""
+        if record.skip_reason or not record.prompt:
+            generate_answer(record)
+            done.put((record.uid, True))
+            return
+        shard_slots = self.shard_slots.setdefault(record.shard, threading.BoundedSemaphore(self.shard_limit))
+        shard_slots.acquire()
+        self.slots.acquire()
+        with self._lock:
+            self._in_flight[record.shard] += 1
+        asyncio.run_coroutine_threadsafe(self._handle(record, done, shard_slots), self.loop)
+
+    async def _handle(self, record, done, shard_slots):
+        ok = True
+        try:
+            answer = await generate_answer_async(record)
+            if answer:
+                ok = await asyncio.to_thread(deliver_answer, record, answer)
+        except GeminiUnavailable as e:
+            logging.warning(f"Odkładam maila ID: {record.uid} na później: {e}")
+            ok = None
+        except Exception as e:
+            logging.error(f"Błąd w silniku async (mail ID: {record.uid}): {e}", exc_info=True)
+            ok = False
+        finally:
+            with self._lock:
+                self._in_flight[record.shard] -= 1
+            self.slots.release()
+            shard_slots.release()
+        done.put((record.uid, ok))
+
+# Uruchamiany w __main__, gdy LLM_WORKERS > 0 (albo ENGINE == "async")
+pipeline = None
+
+# --- Pobieranie wiadomości partiami ---
+
+def uid_set(uids):
+    """Zamienia listę UID na zwarty zbiór IMAP, np. [1, 2, 3, 7] -> "1:3,7"."""
+    parts = []
+    uids = sorted(set(uids))
+    start = prev = None
+    for uid in uids:
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            parts.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = uid
+    if start is not None:
+        parts.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(parts)
+
+def batches(items, size):
+    """Dzieli listę na kolejne kawałki po `size` elementów."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Atom może zawierać sekcję w nawiasach kwadratowych, np. BODY[HEADER.FIELDS (FROM)]<0>
+_FETCH_TOKEN_RE = re.compile(rb'''\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?))''')
+_LITERAL = object()
+
+def _tokenize_fetch(data):
+    """Zamienia surową odpowiedź imaplib na strumień tokenów (literały jako bytes)."""
+    tokens = []
+    for element in data:
+        if isinstance(element, tuple):
+            text, literal = element
+            text = re.sub(rb"\{\d+\}$", b"", text)
+        else:
+            text, literal = element, None
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = _FETCH_TOKEN_RE.match(text, pos)
+            if not match or match.end() == pos:
+                raise imaplib.IMAP4.error(f"Nieoczekiwana odpowiedź FETCH: {text[pos:pos + 40]!r}")
+            pos = match.end()
+            if match.group(1):
+                tokens.append("(")
+            elif match.group(2):
+                tokens.append(")")
+            elif match.group(3) is not None:
+                quoted = re.sub(rb"\\(.)", rb"\1", match.group(3))
+                tokens.append((_LITERAL, quoted.decode("utf-8", errors="replace")))
+            elif match.group(4):
+                atom = match.group(4).decode("ascii", errors="replace")
+                tokens.append(None if atom.upper() == "NIL" else atom)
+        if literal is not None:
+            tokens.append((_LITERAL, literal))
+    return tokens
+
+def _parse_tokens(tokens, pos=0):
+    """Buduje zagnieżdżone listy z tokenów; zwraca (wartości, nowa pozycja)."""
+    values = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            value, pos = _parse_tokens(tokens, pos)
+            values.append(value)
+        elif token == ")":
+            return values, pos
+        elif isinstance(token, tuple):
+            values.append(token[1])
+        else:
+            values.append(token)
+    return values, pos
+
+def parse_fetch_response(data):
+    """Rozbija odpowiedź na UID FETCH wielu wiadomości na słownik {uid: {element: wartość}}.
+
+    Klucze elementów są pisane wielkimi literami (np. "RFC822", "BODYSTRUCTURE",
+    "BODY[1]"); literały zostają jako bytes, łańcuchy w cudzysłowach jako str.
+    """
+    values, _ = _parse_tokens(_tokenize_fetch([d for d in data if d is not None]))
+    messages = {}
+    for value in values:
+        # Format: numer_sekwencyjny (KLUCZ wartość KLUCZ wartość ...)
+        if not isinstance(value, list):
+            continue
+        items = {}
+        for i in range(0, len(value) - 1, 2):
+            key = value[i].upper() if isinstance(value[i], str) else value[i]
+            items[key] = value[i + 1]
+        if "UID" in items:
+            messages[int(items["UID"])] = items
+    return messages
+
+# --- Pobieranie samej części text/plain (BODYSTRUCTURE) ---
+
+_SIMPLE_ENCODINGS = {"7BIT", "8BIT", "BINARY", "BASE64", "QUOTED-PRINTABLE"}
+
+def _is_attachment(disposition):
+    """Czy pole disposition z BODYSTRUCTURE oznacza załącznik."""
+    return isinstance(disposition, list) and bool(disposition) \
+        and isinstance(disposition[0], str) and disposition[0].lower() == "attachment"
+
+def find_text_section(structure, prefix="", subtype="plain"):
+    """Szuka w BODYSTRUCTURE pierwszej części text/<subtype>, która nie jest załącznikiem.
+
+    Zwraca (sekcja, kodowanie, charset), None gdy takiej części nie ma, albo
+    rzuca ValueError, gdy struktura jest nietypowa (wtedy pobieramy całość).
+    """
+    if not isinstance(structure, list) or not structure:
+        raise ValueError("Pusta lub niepoprawna BODYSTRUCTURE")
+
+    if isinstance(structure[0], list):
+        # multipart: najpierw lista części, potem podtyp i rozszerzenia
+        index = 0
+        for part in structure:
+            if not isinstance(part, list):
+                break
+            index += 1
+            found = find_text_section(part, f"{prefix}{index}.", subtype)
+            if found:
+                return found
+        return None
+
+    if len(structure) < 7:
+        raise ValueError("Zbyt krótka BODYSTRUCTURE części")
+    ctype = f"{structure[0]}/{structure[1]}".lower()
+    if ctype == "message/rfc822":
+        # Załączone wiadomości mają własną, zagnieżdżoną strukturę - pobieramy całość
+        raise ValueError("Załączona wiadomość message/rfc822")
+    if ctype != f"text/{subtype}":
+        return None
+
+    # Część tekstowa: typ, podtyp, parametry, id, opis, kodowanie, rozmiar, linie, md5, disposition
+    disposition = structure[9] if len(structure) > 9 else None
+    if _is_attachment(disposition):
+        return None
+    encoding = (structure[5] or "7BIT").upper()
+    if encoding not in _SIMPLE_ENCODINGS:
+        raise ValueError(f"Nieobsługiwane kodowanie {encoding}")
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = None
+    for i in range(0, len(params) - 1, 2):
+        if isinstance(params[i], str) and params[i].lower() == "charset":
+            charset = params[i + 1]
+    # Wiadomość jednoczęściowa: jej treść to sekcja "1"
+    section = prefix[:-1] if prefix else "1"
+    return section, encoding, charset
+
+def decode_html_section(payload, encoding, charset):
+    """Dekoduje pobraną sekcję text/html i zamienia ją na tekst."""
+    return html_to_text(decode_section(payload, encoding, charset))
+
+def decode_section(payload, encoding, charset):
+    """Dekoduje pobraną sekcję (base64 / quoted-printable) do tekstu."""
+    if encoding == "BASE64":
+        payload = binascii.a2b_base64(payload)
+    elif encoding == "QUOTED-PRINTABLE":
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        logging.warning(f"Nieznany charset {charset}, używam utf-8.")
+        return payload.decode(errors='ignore')
+
+def _fetch_item(items, prefix):
+    """Zwraca element odpowiedzi FETCH, którego klucz zaczyna się od `prefix`."""
+    for key, value in items.items():
+        if isinstance(key, str) and key.startswith(prefix):
+            return value
+    return None
+
+def skip_reason_for(headers, size, own_address=EMAIL_ADDRESS):
+    """Zwraca powód pominięcia wiadomości na podstawie samych nagłówków (lub None).
+
+    Pomijamy maile od nas samych, auto-odpowiedzi i zwroty (RFC 3834),
+    pocztę masową i listy mailingowe oraz wiadomości ponad limit rozmiaru.
+    """
+    sender = parseaddr(headers['From'] or "")[1]
+    if sender == own_address:
+        return "mail od samego siebie"
+    if sender.split("@")[0].lower() in ("mailer-daemon", "postmaster"):
+        return "zwrot (bounce)"
+    auto_submitted = (headers['Auto-Submitted'] or "no").strip().lower()
+    if auto_submitted != "no":
+        return f"Auto-Submitted: {auto_submitted}"
+    precedence = (headers['Precedence'] or "").strip().lower()
+    if precedence in ("bulk", "junk", "list", "auto_reply"):
+        return f"Precedence: {precedence}"
+    if headers['List-Id']:
+        return "lista mailingowa"
+    if size is not None and size > MAX_MESSAGE_SIZE:
+        return f"za duży ({size} B)"
+    return None
+
+# --- Strumieniowe parsowanie MIME ---
+
+class StreamingTextExtractor:
+    """Przyrostowy skaner MIME: szuka pierwszej części text/plain w bajtach
+    podawanych kawałkami (feed) i kończy pracę, gdy ją zdekoduje. Pierwszą
+    część text/html zachowuje na wypadek, gdyby text/plain nie było.
+
+    Nie buduje drzewa wiadomości - pamięta tylko stos granic multipart,
+    nagłówki bieżącej części i zbieraną treść (obie rzeczy z limitem).
+    Treść załączników jest przewijana linia po linii, bez dekodowania base64,
+    więc zużycie pamięci nie zależy od rozmiaru wiadomości.
+    """
+
+    # Linia dłuższa niż to nie może być granicą multipart - nie trzymamy jej w całości
+    _MAX_LINE = 64 * 1024
+
+    def __init__(self, max_headers=STREAM_HEADER_MAX_BYTES, max_text=STREAM_TEXT_MAX_BYTES):
+        self.max_headers = max_headers
+        self.max_text = max_text
+        self.headers = None         # nagłówki całej wiadomości
+        self.text = None
+        self.done = False
+        self._buffer = b""
+        self._in_long_line = False  # bieżąca linia jest kontynuacją zbyt długiej linii
+        self._boundaries = []       # stos granic multipart (zagnieżdżenia)
+        self._state = "headers"     # "headers" | "body" (zbieramy treść) | "skip"
+        self._header_lines = []
+        self._header_size = 0
+        self._part = None
+        self._body = []
+        self._body_size = 0
+        self._html = None           # tekst z pierwszej części text/html
+
+    def feed(self, data):
+        """Przetwarza kolejny kawałek wiadomości."""
+        if self.done:
+            return
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line + b"\n")
+            if self.done:
+                return
+        if len(self._buffer) > self._MAX_LINE:
+            self._content(self._buffer)
+            self._buffer = b""
+            self._in_long_line = True
+
+    def close(self):
+        """Koniec danych - domyka ostatnią część."""
+        if self._buffer and not self.done:
+            self._line(self._buffer)
+        self._buffer = b""
+        if self._state == "headers" and self._header_lines:
+            self._headers_done()
+        if self._state == "body":
+            self._finish_text()
+        if self.text is None and self._html is not None:
+            self.text = self._html
+
+    def record(self, uid):
+        """EmailRecord z nagłówków i znalezionej treści."""
+        return record_from_message(self.headers or email.message_from_bytes(b""), uid, prompt=self.text or "")
+
+    def _line(self, line):
+        if self._boundaries and line.startswith(b"--") and not self._in_long_line:
+            marker = line.rstrip()
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                boundary = b"--" + self._boundaries[depth]
+                if marker == boundary:
+                    # Nowa część na tym poziomie zagnieżdżenia
+                    self._end_part()
+                    del self._boundaries[depth + 1:]
+                    self._state, self._header_lines, self._header_size = "headers", [], 0
+                    return
+                if marker == boundary + b"--":
+                    # Koniec multipart - dalej tylko epilog
+                    self._end_part()
+                    del self._boundaries[depth:]
+                    self._state = "skip"
+                    return
+        self._in_long_line = False
+        self._content(line)
+
+    def _content(self, line):
+        if self._state == "headers":
+            if not line.strip() and not self._in_long_line:
+                self._headers_done()
+            elif self._header_size < self.max_headers:
+                self._header_lines.append(line)
+                self._header_size += len(line)
+        elif self._state == "body" and self._body_size < self.max_text:
+            self._body.append(line)
+            self._body_size += len(line)
+
+    def _headers_done(self):
+        headers = email.message_from_bytes(b"".join(self._header_lines))
+        self._header_lines, self._header_size = [], 0
+        if self.headers is None:
+            self.headers = headers
+        self._state = "skip"
+        if headers.get_content_maintype() == "multipart":
+            boundary = headers.get_boundary()
+            if boundary:
+                self._boundaries.append(boundary.encode("ascii", errors="replace"))
+            return
+        disposition = str(headers.get("Content-Disposition") or "").lower()
+        ctype = headers.get_content_type()
+        if "attachment" in disposition:
+            return
+        if ctype == "text/plain" or (ctype == "text/html" and self._html is None):
+            self._part, self._body, self._body_size = headers, [], 0
+            self._state = "body"
+
+    def _end_part(self):
+        if self._state == "body":
+            self._finish_text()
+
+    def _finish_text(self):
+        payload = b"".join(self._body)
+        encoding = str(self._part.get("Content-Transfer-Encoding") or "7bit").strip().upper()
+        if encoding == "BASE64":
+            # Treść mogła zostać ucięta na limicie - dekodujemy pełne grupy znaków
+            payload = re.sub(rb"\s+", b"", payload)
+            payload = payload[:len(payload) - len(payload) % 4]
+        text = decode_section(payload, encoding, self._part.get_content_charset())
+        self._state = "skip"
+        if self._part.get_content_type() == "text/html":
+            # Zapasowo - szukamy dalej części text/plain
+            self._html = html_to_text(text)
+            return
+        self.text = text
+        self.done = True
+
+def parse_message_bytes(raw, uid, chunk_size=STREAM_FETCH_CHUNK_BYTES):
+    """Parsuje surową wiadomość do zwięzłego EmailRecord (wywoływane także w procesach roboczych)."""
+    extractor = StreamingTextExtractor()
+    for offset in range(0, len(raw), chunk_size):
+        extractor.feed(raw[offset:offset + chunk_size])
+        if extractor.done:
+            break
+    extractor.close()
+    return extractor.record(uid)
+
+def fetch_text_streaming(mail, uid, chunk_size=STREAM_FETCH_CHUNK_BYTES):
+    """Pobiera dużą wiadomość kawałkami (BODY.PEEK[]<początek.długość>) i parsuje ją w locie.
+
+    Kończy, gdy tylko znajdzie treść - reszty (zwykle załączników) nie pobiera.
+    Zwraca treść albo None.
+    """
+    extractor = StreamingTextExtractor()
+    offset = 0
+    while not extractor.done:
+        status, data = mail.uid("FETCH", str(uid), f"(UID BODY.PEEK[]<{offset}.{chunk_size}>)")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Nie udało się pobrać fragmentu maila ID: {uid}")
+        chunk = _fetch_item(parse_fetch_response(data).get(uid, {}), "BODY[]")
+        if not isinstance(chunk, bytes) or not chunk:
+            break
+        extractor.feed(chunk)
+        offset += len(chunk)
+        if len(chunk) < chunk_size:
+            break
+    extractor.close()
+    metrics.inc("stream_fetched_bytes", offset)
+    return extractor.text
+
+# --- Parsowanie w puli procesów ---
+
+def _attach_shared_memory(name):
+    """Dołącza się do bloku pamięci współdzielonej utworzonego przez proces agenta."""
+    shm = shared_memory.SharedMemory(name=name)
+    # Blok należy do rodzica (on go usuwa) - proces roboczy nie może go zgłaszać jako swój
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _run_parser(parser, payload, *args):
+    """Proces roboczy: odtwarza bajty (wprost albo z pamięci współdzielonej) i wywołuje parser."""
+    if isinstance(payload, tuple):
+        name, size = payload
+        shm = _attach_shared_memory(name)
+        try:
+            payload = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+    return parser(payload, *args)
+
+def create_parse_pool(workers=PARSE_WORKERS):
+    """Tworzy pulę procesów do parsowania (albo None, gdy PARSE_WORKERS = 0).
+
+    Trzeba ją utworzyć na samym początku, zanim wystartują wątki agenta -
+    procesy robocze powstają przez fork.
+    """
+    if workers <= 0:
+        return None
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    logging.info(f"Uruchamiam pulę {workers} procesów do parsowania wiadomości.")
+    return multiprocessing.get_context(method).Pool(workers)
+
+# Ustawiana w __main__ (create_parse_pool)
+parse_pool = None
+
+def run_parsers(jobs):
+    """Wykonuje zadania {klucz: (parser, bajty, *argumenty)} i zwraca {klucz: wynik}.
+
+    Duże wiadomości trafiają równolegle do puli procesów (jeśli działa),
+    największe - przez pamięć współdzieloną. Wynik None oznacza błąd parsowania.
+    """
+    results, pending, segments = {}, {}, []
+    try:
+        for key, (parser, raw, *args) in jobs.items():
+            if parse_pool is None or len(raw) < PARSE_POOL_MIN_BYTES:
+                try:
+                    results[key] = parser(raw, *args)
+                except (ValueError, UnicodeError) as e:
+                    # binascii.Error (złe wypełnienie base64) dziedziczy po ValueError
+                    logging.warning(f"Błąd parsowania wiadomości {key}: {e!r}")
+                    results[key] = None
+                continue
+            payload = raw
+            if len(raw) >= PARSE_SHM_MIN_BYTES:
+                shm = shared_memory.SharedMemory(create=True, size=len(raw))
+                shm.buf[:len(raw)] = raw
+                segments.append(shm)
+                payload = (shm.name, len(raw))
+            pending[key] = parse_pool.apply_async(_run_parser, (parser, payload, *args))
+        for key, result in pending.items():
+            try:
+                results[key] = result.get(PARSE_TIMEOUT_SEC)
+            except Exception as e:
+                logging.warning(f"Błąd parsowania wiadomości {key} w puli procesów: {e!r}")
+                results[key] = None
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+    metrics.inc("messages_parsed_in_pool", len(pending))
+    return results
+
+def fetch_records(mail, uids, own_address=EMAIL_ADDRESS):
+    """Pobiera partię wiadomości i zwraca słownik {uid: EmailRecord}.
+
+    Pierwszy, tani przebieg pobiera dla całej partii tylko potrzebne nagłówki,
+    RFC822.SIZE i BODYSTRUCTURE; wiadomości, które i tak pominiemy, nie są
+    pobierane dalej. Dla pozostałych pobieramy tylko część text/plain
+    (BODY.PEEK[sekcja]) - bez załączników. Wiadomości o nietypowej
+    strukturze są pobierane w całości.
+    """
+    header_item = f"BODY.PEEK[HEADER.FIELDS ({FETCH_HEADER_FIELDS})]"
+    status, data = mail.uid("FETCH", uid_set(uids), f"(UID RFC822.SIZE BODYSTRUCTURE {header_item})")
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"Nie udało się pobrać nagłówków dla {uid_set(uids)}")
+    first_pass = parse_fetch_response(data)
+
+    records = {}
+    by_section = {}  # sekcja -> [uid]
+    sections = {}
+    full_fetch = []
+    streamed = []
+    for uid in uids:
+        item = first_pass.get(uid)
+        headers = _fetch_item(item, "BODY[HEADER") if item else None
+        if not isinstance(headers, bytes):
+            continue
+        headers = email.message_from_bytes(headers)
+        record = record_from_message(headers, uid, prompt="")
+        records[uid] = record
+
+        size = item.get("RFC822.SIZE")
+        record.skip_reason = skip_reason_for(headers, int(size) if size else None, own_address)
+        if record.skip_reason:
+            continue
+
+        try:
+            structure = item.get("BODYSTRUCTURE")
+            found = find_text_section(structure)
+            if not found:
+                # Brak text/plain (częste w Outlooku i na telefonach) - bierzemy HTML
+                found = find_text_section(structure, subtype="html")
+                if found:
+                    metrics.inc("html_fallbacks")
+                    found = (found[0], found[1], found[2], True)
+        except ValueError as e:
+            if size and int(size) >= STREAM_PARSE_MIN_BYTES:
+                # Duże wiadomości - kawałkami, bez trzymania całości w pamięci
+                logging.info(f"Nietypowa struktura maila ID: {uid} ({e}) - pobieram strumieniowo.")
+                streamed.append(uid)
+            else:
+                logging.info(f"Nietypowa struktura maila ID: {uid} ({e}) - pobieram całość.")
+                full_fetch.append(uid)
+            continue
+        if found:
+            sections[uid] = found
+            by_section.setdefault(found[0], []).append(uid)
+
+    for section, section_uids in by_section.items():
+        # Wiadomości z tą samą sekcją (np. "1" albo "1.1") pobieramy jedną komendą
+        status, data = mail.uid("FETCH", uid_set(section_uids), f"(UID BODY.PEEK[{section}])")
+        if status != "OK":
+            logging.warning(f"Nie udało się pobrać treści maili: {uid_set(section_uids)}")
+            for uid in section_uids:
+                records.pop(uid, None)
+            continue
+        fetched = parse_fetch_response(data)
+        jobs = {}
+        for uid in section_uids:
+            payload = _fetch_item(fetched.get(uid, {}), f"BODY[{section}]")
+            if not isinstance(payload, bytes):
+                records.pop(uid, None)
+                continue
+            _, encoding, charset, *is_html = sections[uid]
+            jobs[uid] = (decode_html_section if is_html else decode_section, payload, encoding, charset)
+        # Duże sekcje HTML konwertujemy w puli procesów (jeśli działa)
+        for uid, text in run_parsers(jobs).items():
+            if text is None:
+                # Uszkodzone kodowanie sekcji - parser email jest wyrozumialszy
+                logging.info(f"Nie udało się zdekodować sekcji maila ID: {uid} - pobieram całość.")
+                full_fetch.append(uid)
+            else:
+                records[uid].prompt = text
+
+    if full_fetch:
+        status, data = mail.uid("FETCH", uid_set(full_fetch), "(UID BODY.PEEK[])")
+        fetched = parse_fetch_response(data) if status == "OK" else {}
+        if status != "OK":
+            logging.warning(f"Nie udało się pobrać maili: {uid_set(full_fetch)}")
+        jobs = {}
+        for uid in full_fetch:
+            raw_email = fetched.get(uid, {}).get("BODY[]")
+            if isinstance(raw_email, bytes):
+                jobs[uid] = (parse_message_bytes, raw_email, uid)
+            else:
+                records.pop(uid, None)
+        # Parsowanie całych wiadomości to czysta praca CPU - przy PARSE_WORKERS idzie równolegle
+        for uid, parsed in run_parsers(jobs).items():
+            if parsed is None:
+                records.pop(uid, None)
+            else:
+                records[uid].prompt = parsed.prompt
+
+    for uid in streamed:
+        try:
+            records[uid].prompt = fetch_text_streaming(mail, uid)
+        except imaplib.IMAP4.error as e:
+            logging.warning(f"Nie udało się pobrać maila ID: {uid}: {e}")
+            records.pop(uid, None)
+
+    return records
+
+def commit_completed(mail, checkpoint, resync=False, shard=None):
+    """Zatwierdza maile obsłużone przez potok: jedno UID STORE \\Seen i przesunięcie punktu kontrolnego."""
+    results = []
+    while True:
+        try:
+            results.append(checkpoint.done.get_nowait())
+        except queue.Empty:
+            break
+
+    # Oznacz obsłużone maile jako przeczytane (Seen) jedną komendą UID STORE
+    to_flag = [uid for uid, ok in results if checkpoint.finish(uid, ok)]
+    if to_flag:
+        mail.uid("STORE", uid_set(to_flag), '+FLAGS', r'(\Seen)')
+        shard = shard or default_shard
+        if ledger is not None:
+            ledger.mark_flagged(to_flag, shard.name)
+        if COORDINATION == "claim":
+            shard.claims.release(mail, to_flag)
+
+    if SYNC_MODE == "uid" and not resync:
+        checkpoint.advance_watermark()
+    else:
+        # Oznaczone maile i tak nie wrócą w wyszukiwaniu UNSEEN
+        checkpoint.committed.clear()
+
+def check_emails(shard=None):
+    """Główna funkcja sprawdzająca i przetwarzająca nowe e-maile jednej skrzynki.
+
+    Korzysta z długo żyjącej sesji IMAP i punktu kontrolnego synchronizacji
+    danego sharda (domyślnie `imap_session` i `sync_checkpoint`). Gdy działa
+    potok (`pipeline`), maile są do niego przekazywane, a tutaj tylko zatwierdzane.
+
+    Zwraca liczbę znalezionych nowych wiadomości (0 także przy błędzie).
+    """
+    shard = shard or default_shard
+    session, checkpoint = shard.session, shard.checkpoint
+
+    try:
+        mail = session.get()
+        logging.info(f"Sprawdzam nowe wiadomości ({shard.name})...")
+
+        # Najpierw zatwierdzamy to, co potok obsłużył od ostatniego cyklu
+        commit_completed(mail, checkpoint, needs_resync(session, checkpoint), shard)
+
+        mail_ids, resync_base = find_new_uids(mail, session, checkpoint)
+        resync = resync_base is not None
+
+        # Maile obsługiwane właśnie w tle nie są pobierane drugi raz
+        mail_ids = [uid for uid in mail_ids if not checkpoint.is_pending(uid)]
+
+        if mail_ids and gemini_breaker.is_open():
+            # Gemini nie działa - nie pobieramy i nie oznaczamy poczty, poczeka na serwerze
+            logging.warning(f"Gemini niedostępne - wstrzymuję pobieranie {len(mail_ids)} wiadomości.")
+            return 0
+
+        # Przy wielu replikach bierzemy tylko "swoje" maile
+        mail_ids = coordinate(mail, shard, mail_ids)
+
+        if not mail_ids:
+            logging.info("Brak nowych wiadomości.")
+        else:
+            logging.info(f"Znaleziono {len(mail_ids)} nowych wiadomości ({shard.name}).")
+
+        taken = 0
+        while taken < len(mail_ids):
+            if gemini_breaker.is_open():
+                logging.warning("Gemini niedostępne - przerywam pobieranie kolejnych partii.")
+                break
+
+            # Nie pobieramy (i nie rezerwujemy) więcej, niż potok przyjmie bez czekania
+            size = FETCH_BATCH_SIZE if pipeline is None else min(FETCH_BATCH_SIZE, pipeline.capacity(shard.name))
+            if size <= 0:
+                logging.info(f"Potok pełny - {len(mail_ids) - taken} wiadomości poczeka na kolejny cykl.")
+                break
+            chunk = mail_ids[taken:taken + size]
+            taken += len(chunk)
+            if COORDINATION == "claim":
+                chunk = claim_batch(mail, shard, chunk)
+                if not chunk:
+                    continue
+
+            # Kilka komend FETCH dla całej partii zamiast jednej na wiadomość
+            records = fetch_records(mail, chunk, shard.account.address)
+            for record in records.values():
+                record.shard = shard.name
+
+            for mail_id in chunk:
+                if COORDINATION == "claim":
+                    # Pobieranie i poprzednie maile partii mogły trwać - rezerwacja musi być wciąż nasza
+                    renew_claims(mail, shard)
+                    if mail_id not in shard.claims.held:
+                        continue
+                record = records.get(mail_id)
+                checkpoint.begin(mail_id)
+                if record is None:
+                    # NO na FETCH, brak literału albo błąd parsowania - mail zostaje
+                    # nieprzeczytany i wróci w kolejnym cyklu (do SEND_MAX_ATTEMPTS prób)
+                    logging.warning(f"Nie udało się pobrać maila ID: {mail_id}")
+                    checkpoint.done.put((mail_id, False))
+                elif pipeline is not None:
+                    pipeline.submit(record, checkpoint.done)
+                else:
+                    checkpoint.done.put((mail_id, process_email(record)))
+
+            # Robimy to niezależnie od tego, czy odpowiedź Gemini się udała, aby nie utknąć
+            commit_completed(mail, checkpoint, resync, shard)
+
+        if resync and taken == len(mail_ids) and not checkpoint.in_flight and not checkpoint.failed:
+            # Zapisujemy dopiero po obsłużeniu wszystkiego - po awarii
+            # resynchronizacja powtórzy się i pominie już przeczytane maile
+            checkpoint.reset(session.uidvalidity, resync_base)
+        return len(mail_ids)
+
+    except (imaplib.IMAP4.abort, OSError) as e:
+        # Połączenie zostało zerwane - następny cykl połączy się ponownie
+        logging.error(f"Utracono połączenie IMAP w check_emails: {e}")
+        session.invalidate()
+    except Exception as e:
+        logging.error(f"Wystąpił błąd w głównej funkcji check_emails: {e}", exc_info=True)
+    return 0
+
+# --- Adaptacyjne odpytywanie ---
+
+class PollScheduler:
+    """Dobiera odstęp między sprawdzeniami poczty do ruchu.
+
+    Po cyklu z nowymi mailami odstęp spada do minimum (maile często
+    przychodzą seriami), po pustym cyklu rośnie wykładniczo do sufitu. Odstęp
+    liczymy od początku cyklu - czas check_emails() jest od niego odejmowany.
+    """
+
+    def __init__(self, initial=CHECK_INTERVAL_SEC, minimum=POLL_MIN_INTERVAL_SEC,
+                 maximum=POLL_MAX_INTERVAL_SEC, factor=POLL_BACKOFF_FACTOR, jitter=POLL_JITTER):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.jitter = jitter
+        self.interval = min(max(initial, minimum), self.maximum)
+
+    def next_delay(self, found, elapsed, busy=False):
+        """Ile spać po cyklu, który znalazł `found` maili i trwał `elapsed` sekund."""
+        if found or busy:
+            # Seria maili albo praca w tle do zatwierdzenia - sprawdzamy szybko
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.maximum, self.interval * self.factor)
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, delay - elapsed)
+
+# --- IMAP IDLE (tryb push) ---
+
+def imap_supports_idle(mail):
+    """Sprawdza, czy serwer IMAP ogłasza rozszerzenie IDLE (RFC 2177)."""
+    return "IDLE" in mail.capabilities
+
+def _idle_data_ready(mail, timeout):
+    """Czy w sesji czeka odpowiedź serwera - w buforze imaplib, w buforze SSL albo w gnieździe.
+
+    Czeka najdłużej `timeout` sekund.
+    """
+    sock = mail.sock
+    previous = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        # Nieblokujące peek widzi też dane, które imaplib przeczytał już "na zapas"
+        # (tych select() nie zgłosi) i dane czekające w buforze SSL
+        if mail.file.peek(1):
+            return True
+    except OSError:
+        pass  # np. SSLWantReadError - brak pełnego rekordu SSL
+    finally:
+        sock.settimeout(previous)
+    if timeout <= 0:
+        return False
+    readable, _, _ = select.select([sock], [], [], timeout)
+    return bool(readable)
+
+def _read_idle_line(mail, deadline):
+    """Czyta jedną linię odpowiedzi (przez imaplib), czekając najdłużej do `deadline`.
+
+    Zwraca linię (bez CRLF) albo None, jeśli minął czas.
+    """
+    while not _idle_data_ready(mail, deadline - time.monotonic()):
+        if time.monotonic() >= deadline:
+            return None
+    line = mail.readline()
+    if not line:
+        raise imaplib.IMAP4.abort("socket error: EOF podczas IDLE")
+    return line.rstrip(b"\r\n")
+
+_idle_tags = iter(range(1, sys.maxsize))
+
+def imap_idle(mail, timeout):
+    """Czeka w trybie IDLE, aż serwer zgłosi nową wiadomość (EXISTS).
+
+    Zwraca True, jeśli przyszła nowa poczta, False po upływie `timeout` sekund.
+    """
+    # Własny tag - nie mieszamy się w wewnętrzną numerację komend imaplib
+    tag = f"IDLE{next(_idle_tags)}".encode()
+    mail.send(tag + b" IDLE\r\n")
+
+    line = _read_idle_line(mail, time.monotonic() + 30)
+    if line is None or not line.startswith(b"+"):
+        raise imaplib.IMAP4.abort(f"Serwer nie przyjął komendy IDLE: {line!r}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        line = _read_idle_line(mail, deadline)
+        if line is None:
+            break
+        if line.startswith(b"*") and line.upper().endswith(b"EXISTS"):
+            new_mail = True
+
+    # Kończymy IDLE i czekamy na odpowiedź z naszym tagiem
+    mail.send(b"DONE\r\n")
+    deadline = time.monotonic() + 30
+    while True:
+        line = _read_idle_line(mail, deadline)
+        if line is None:
+            raise imaplib.IMAP4.abort("Brak odpowiedzi serwera na DONE")
+        if line.startswith(tag + b" "):
+            if b" OK" not in line.upper():
+                raise imaplib.IMAP4.error(f"IDLE zakończone błędem: {line!r}")
+            return new_mail
+
+def run_polling_loop(shard=None):
+    """Klasyczna pętla odpytywania z odstępem dopasowanym do ruchu (PollScheduler)."""
+    shard = shard or default_shard
+    scheduler = PollScheduler()
+    logging.info(f"Sprawdzanie poczty co {POLL_MIN_INTERVAL_SEC}-{POLL_MAX_INTERVAL_SEC} sekund, zależnie od ruchu.")
+    while True:
+        started = time.monotonic()
+        found = 0
+        try:
+            found = check_emails(shard)
+        except Exception as e:
+            logging.critical(f"Krytyczny błąd w głównej pętli: {e}", exc_info=True)
+
+        busy = bool(shard.checkpoint.in_flight or shard.checkpoint.failed)
+        delay = scheduler.next_delay(found, time.monotonic() - started, busy)
+        logging.info(f"Odpoczywam przez {delay:.0f} sekund...")
+        time.sleep(delay)
+
+def run_idle_loop(shard=None):
+    """Pętla push: jedna otwarta sesja IMAP, wybudzana przez IDLE.
+
+    Jeśli serwer nie obsługuje IDLE, przechodzi na zwykłe odpytywanie.
+    """
+    shard = shard or default_shard
+    session, checkpoint = shard.session, shard.checkpoint
+    while True:
+        try:
+            mail = session.get()
+            if not imap_supports_idle(mail):
+                logging.warning(f"Serwer nie obsługuje IDLE ({shard.name}) - przechodzę na odpytywanie.")
+                run_polling_loop(shard)
+                return
+
+            # Nowe maile mogą przyjść w trakcie przetwarzania - wtedy
+            # serwer zgłosi EXISTS i sprawdzamy ponownie bez czekania
+            mail.untagged_responses.pop("EXISTS", None)
+            check_emails(shard)
+            if session.mail is not mail or "EXISTS" in mail.untagged_responses:
+                continue
+
+            logging.info("Czekam na nowe wiadomości (IDLE)...")
+            # Gdy potok obsługuje maile w tle, budzimy się częściej, by je zatwierdzić
+            busy = checkpoint.in_flight or checkpoint.failed
+            new_mail = imap_idle(mail, PIPELINE_COMMIT_INTERVAL_SEC if busy else IDLE_TIMEOUT_SEC)
+            session.touch()
+            if new_mail:
+                logging.info("Serwer zgłosił nową wiadomość.")
+            else:
+                logging.info("Odnawiam IDLE.")
+        except Exception as e:
+            logging.critical(f"Krytyczny błąd w pętli IDLE: {e}", exc_info=True)
+            session.invalidate()
+            time.sleep(5) # Krótka przerwa przed ponownym połączeniem
+
+def run_shards():
+    """Uruchamia pętlę IMAP (IDLE albo odpytywanie) każdej skrzynki we własnym wątku."""
+    loop = run_idle_loop if USE_IDLE else run_polling_loop
+    if len(shards) == 1:
+        loop(next(iter(shards.values())))
+        return
+    threads = [threading.Thread(target=loop, args=(shard,), name=f"imap-{shard.name}", daemon=True)
+               for shard in shards.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+async def run_async_engine():
+    """Silnik asyncio: pętla IMAP działa w wątku, a Gemini w pętli zdarzeń."""
+    global pipeline
+    logging.info(f"Uruchamiam silnik async (do {ASYNC_MAX_IN_FLIGHT} zapytań Gemini naraz).")
+    pipeline = AsyncPipeline(asyncio.get_running_loop())
+    await gemini_client.warm_up_async()
+    for account in accounts():
+        account.outbox.start_flusher()
+    metrics.start_logging()
+    if GEMINI_KEEPALIVE_SEC > 0:
+        gemini_client.start_keepalive_async()
+    await asyncio.to_thread(run_shards)
+
+# --- Główna pętla agenta ---
+
+# ... (cały kod agenta) ...
+
+# --- Główna pętla agenta ---
+if __name__ == "__main__":
+    logging.info("Agent AI startuje...")
+    # Przed startem jakichkolwiek wątków (fork)
+    parse_pool = create_parse_pool()
+
+    if COORDINATION not in ("none", "modulo", "claim") or not 0 <= WORKER_INDEX < WORKER_COUNT:
+        logging.fatal(f"BŁĄD: Niepoprawne COORDINATION={COORDINATION} / WORKER_INDEX={WORKER_INDEX} / WORKER_COUNT={WORKER_COUNT}.")
+        sys.exit(1)
+
+    if ACCOUNTS_FILE:
+        try:
+            load_shards()
+        except (OSError, KeyError, ValueError) as e:
+            logging.fatal(f"BŁĄD: Niepoprawny plik kont {ACCOUNTS_FILE}: {e!r}")
+            sys.exit(1)
+
+    if ENGINE == "async":
+        asyncio.run(run_async_engine())
+    else:
+        gemini_client.warm_up()
+        for account in accounts():
+            account.outbox.start_flusher()
+        metrics.start_logging()
+        if GEMINI_KEEPALIVE_SEC > 0:
+            gemini_client.start_keepalive()
+
+        if LLM_WORKERS > 0:
+            logging.info(f"Uruchamiam potok przetwarzania z {LLM_WORKERS} wątkami Gemini.")
+            pipeline = Pipeline()
+
+        run_shards()
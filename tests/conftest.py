@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# agent.py czyta konfigurację przy imporcie - ustawiamy ją przed importem
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("EMAIL_ADDRESS", "agent@example.com")
+os.environ.setdefault("EMAIL_PASSWORD", "test")
+os.environ["STATE_DIR"] = tempfile.mkdtemp(prefix="agent-tests-")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,91 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def make_checkpoint(tmp_path):
+    checkpoint = agent.SyncCheckpoint(str(tmp_path / "inbox.json"))
+    checkpoint.reset(7, 100)
+    return checkpoint
+
+
+def test_checkpoint_persists(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.advance(105)
+    checkpoint.advance(103)
+    reloaded = agent.SyncCheckpoint(checkpoint.path)
+    assert (reloaded.uidvalidity, reloaded.last_uid) == (7, 105)
+
+
+def test_watermark_waits_for_lower_uids(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    for uid in (101, 102, 103):
+        checkpoint.begin(uid)
+    assert checkpoint.finish(101, True)
+    assert checkpoint.finish(103, True)
+    checkpoint.advance_watermark()
+    assert checkpoint.last_uid == 101
+    assert checkpoint.is_pending(102) and checkpoint.is_pending(103)
+
+    assert checkpoint.finish(102, True)
+    checkpoint.advance_watermark()
+    assert checkpoint.last_uid == 103
+    assert not checkpoint.committed
+
+
+def test_failed_uid_is_retried_until_limit(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    for attempt in range(1, agent.SEND_MAX_ATTEMPTS):
+        checkpoint.begin(101)
+        assert not checkpoint.finish(101, False)
+        assert checkpoint.failed[101] == attempt
+        assert not checkpoint.is_pending(101)
+        checkpoint.advance_watermark()
+        assert checkpoint.last_uid == 100
+    checkpoint.begin(101)
+    assert checkpoint.finish(101, False)
+    checkpoint.advance_watermark()
+    assert checkpoint.last_uid == 101
+    assert not checkpoint.failed
+
+
+def test_deferred_uid_does_not_use_attempts(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    for _ in range(agent.SEND_MAX_ATTEMPTS + 1):
+        checkpoint.begin(101)
+        assert not checkpoint.finish(101, None)
+    assert checkpoint.failed == {101: 0}
+    checkpoint.advance_watermark()
+    assert checkpoint.last_uid == 100
+
+
+class ResyncMailbox:
+    """Skrzynka, do której przychodzi mail dokładnie między dwoma wyszukiwaniami."""
+
+    def __init__(self):
+        self.unseen = [3, 5]
+        self.highest = 5
+
+    def uid(self, command, charset, *criteria):
+        if criteria == ("UNSEEN",):
+            result = list(self.unseen)
+            self.unseen.append(6)
+            self.highest = 6
+            return "OK", [" ".join(map(str, result)).encode()]
+        if criteria == ("UID", "*"):
+            result = [self.highest]
+            self.unseen.append(6)
+            self.highest = 6
+            return "OK", [" ".join(map(str, result)).encode()]
+        raise AssertionError(criteria)
+
+
+def test_resync_does_not_skip_mail_arriving_between_searches(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "SYNC_MODE", "uid")
+    checkpoint = agent.SyncCheckpoint(str(tmp_path / "inbox.json"))
+    session = type("Session", (), {"uidvalidity": 9})()
+    uids, base = agent.find_new_uids(ResyncMailbox(), session, checkpoint)
+    # UID 6 jest albo na liście, albo za początkiem nowej serii
+    assert 6 in uids or base < 6
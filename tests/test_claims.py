@@ -0,0 +1,193 @@
+import re
+import types
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+class ClaimsMailbox:
+    """Skrzynka IMAP w pamięci: UID SEARCH UNSEEN, FETCH FLAGS/MODSEQ i STORE (z UNCHANGEDSINCE)."""
+
+    capabilities = ("IMAP4REV1", "CONDSTORE")
+
+    def __init__(self, count):
+        self.flags = {uid: set() for uid in range(1, count + 1)}
+        self.modseq = {uid: 1 for uid in self.flags}
+        self.highest = 1
+
+    def _uids(self, spec):
+        uids = []
+        for part in spec.split(","):
+            first, _, last = part.partition(":")
+            uids += range(int(first), int(last or first) + 1)
+        return [uid for uid in uids if uid in self.flags]
+
+    def uid(self, command, *args):
+        if command == "SEARCH":
+            return "OK", [" ".join(str(uid) for uid in self.flags if "\\Seen" not in self.flags[uid]).encode()]
+        if command == "FETCH":
+            lines = []
+            for uid in self._uids(args[0]):
+                modseq = f" MODSEQ ({self.modseq[uid]})" if "MODSEQ" in args[1] else ""
+                lines.append(f"1 (UID {uid} FLAGS ({' '.join(sorted(self.flags[uid]))}){modseq})".encode())
+            return "OK", lines
+        if command == "STORE":
+            rest, limit = list(args[1:]), None
+            if rest[0].startswith("(UNCHANGEDSINCE"):
+                limit = int(rest.pop(0)[len("(UNCHANGEDSINCE "):-1])
+            operation, flags = rest[0], rest[1].strip("()").split()
+            for uid in self._uids(args[0]):
+                if limit is not None and self.modseq[uid] > limit:
+                    continue
+                if operation.startswith("+"):
+                    self.flags[uid].update(flags)
+                else:
+                    self.flags[uid].difference_update(flags)
+                self.highest += 1
+                self.modseq[uid] = self.highest
+            return "OK", []
+        raise AssertionError(command)
+
+    def keywords(self, uid):
+        return sorted(flag for flag in self.flags[uid] if flag.startswith(agent.CLAIM_KEYWORD_PREFIX))
+
+
+def age(mailbox, claims, seconds):
+    """Postarza rezerwacje repliki `claims` o `seconds` (na serwerze i w jej pamięci)."""
+    def older(keyword):
+        return re.sub(r"_(\d+)_", lambda m: f"_{int(m.group(1)) - seconds}_", keyword, count=1)
+    for flags in mailbox.flags.values():
+        mine = {flag for flag in flags if flag.endswith(f"_{claims.worker_id}")}
+        flags.difference_update(mine)
+        flags.update(older(flag) for flag in mine)
+    claims.held = {uid: older(keyword) for uid, keyword in claims.held.items()}
+
+
+def test_only_one_replica_wins_and_loser_leaves_no_keyword():
+    mailbox = ClaimsMailbox(3)
+    first, second = agent.MessageClaims("w1"), agent.MessageClaims("w2")
+    assert first.claim(mailbox, [1, 2]) == [1, 2]
+    assert second.claim(mailbox, [1, 2, 3]) == [3]
+    assert all(len(mailbox.keywords(uid)) == 1 for uid in (1, 2, 3))
+
+
+def test_renew_keeps_claim_alive():
+    mailbox = ClaimsMailbox(1)
+    first, second = agent.MessageClaims("w1"), agent.MessageClaims("w2")
+    first.claim(mailbox, [1])
+    age(mailbox, first, agent.CLAIM_RENEW_AFTER_SEC + 1)
+    assert first.renew(mailbox) == []
+    assert mailbox.keywords(1) == [first.held[1]]
+    age(mailbox, first, agent.CLAIM_RENEW_AFTER_SEC)
+    assert second.claim(mailbox, [1]) == []
+
+
+def test_expired_claim_nobody_took_is_claimed_again():
+    mailbox = ClaimsMailbox(1)
+    claims = agent.MessageClaims("w1")
+    claims.claim(mailbox, [1])
+    age(mailbox, claims, agent.CLAIM_TIMEOUT_SEC + 1)
+    assert claims.renew(mailbox) == []
+    assert mailbox.keywords(1) == [claims.held[1]]
+    assert agent.MessageClaims("w2").claim(mailbox, [1]) == []
+
+
+def test_release_removes_keyword():
+    mailbox = ClaimsMailbox(1)
+    claims = agent.MessageClaims("w1")
+    claims.claim(mailbox, [1])
+    claims.release(mailbox, [1])
+    assert mailbox.keywords(1) == [] and claims.held == {}
+
+
+def make_shard(tmp_path, mailbox, worker_id="w1"):
+    checkpoint = agent.SyncCheckpoint(str(tmp_path / f"inbox_{worker_id}.json"))
+    checkpoint.reset(7, 0)
+    session = types.SimpleNamespace(get=lambda: mailbox, uidvalidity=7, invalidate=lambda: None)
+    shard = types.SimpleNamespace(name="inbox", claims=agent.MessageClaims(worker_id), checkpoint=checkpoint,
+                                  session=session, account=types.SimpleNamespace(address="agent@x"))
+    shard.claims.last_reclaim = float("inf")
+    return shard
+
+
+def test_claim_batch_forgets_mail_taken_over_by_other_replica(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "COORDINATION", "claim")
+    mailbox = ClaimsMailbox(2)
+    shard = make_shard(tmp_path, mailbox)
+    checkpoint = shard.checkpoint
+    assert agent.coordinate(mailbox, shard, [1, 2]) == [1, 2]
+    assert shard.claims.held == {}
+    assert agent.claim_batch(mailbox, shard, [1, 2]) == [1, 2]
+    for uid in (1, 2):
+        checkpoint.begin(uid)
+    checkpoint.finish(1, None)
+    checkpoint.finish(2, True)
+
+    # Replika w1 stoi dłużej niż CLAIM_TIMEOUT_SEC, mail 1 przejmuje w2
+    age(mailbox, shard.claims, agent.CLAIM_TIMEOUT_SEC + 1)
+    shard.claims.held.pop(2)
+    assert agent.MessageClaims("w2").claim(mailbox, [1]) == [1]
+
+    assert agent.claim_batch(mailbox, shard, [1]) == []
+    assert checkpoint.failed == {} and shard.claims.held == {}
+    assert all("w1" not in keyword for keyword in mailbox.keywords(1))
+    checkpoint.advance_watermark()
+    assert checkpoint.last_uid == 2
+
+
+class FakePipeline:
+    """Potok o stałej pojemności; `on_submit` pozwala zasymulować długie czekanie w submit()."""
+
+    def __init__(self, size, on_submit=None):
+        self.size = size
+        self.on_submit = on_submit
+        self.submitted = []
+
+    def capacity(self, key):
+        return self.size - len(self.submitted)
+
+    def submit(self, record, done):
+        self.submitted.append(record.uid)
+        if self.on_submit:
+            self.on_submit(record)
+
+
+def run_cycle(monkeypatch, mailbox, shard, pipeline):
+    monkeypatch.setattr(agent, "COORDINATION", "claim")
+    monkeypatch.setattr(agent, "pipeline", pipeline)
+    monkeypatch.setattr(agent, "needs_resync", lambda session, checkpoint: False)
+    monkeypatch.setattr(agent, "find_new_uids", lambda mail, session, checkpoint: (sorted(mailbox.flags), None))
+    monkeypatch.setattr(agent, "fetch_records", lambda mail, uids, own: {
+        uid: agent.EmailRecord(uid=uid, sender="jan@x", subject="s", message_id=f"<q{uid}@x>", prompt="?")
+        for uid in uids})
+    return agent.check_emails(shard)
+
+
+def test_replica_claims_only_what_its_pipeline_accepts(tmp_path, monkeypatch):
+    mailbox = ClaimsMailbox(4)
+    shard = make_shard(tmp_path, mailbox)
+    pipeline = FakePipeline(2)
+    run_cycle(monkeypatch, mailbox, shard, pipeline)
+    assert pipeline.submitted == [1, 2]
+    assert sorted(shard.claims.held) == [1, 2]
+    assert agent.MessageClaims("w2").claim(mailbox, [1, 2, 3, 4]) == [3, 4]
+
+
+def test_claim_lost_while_submit_blocks_is_not_submitted(tmp_path, monkeypatch):
+    mailbox = ClaimsMailbox(2)
+    shard = make_shard(tmp_path, mailbox)
+    other = agent.MessageClaims("w2")
+
+    def stall(record):
+        # Backpressure trwa dłużej niż CLAIM_TIMEOUT_SEC - mail 2 przejmuje w2
+        if record.uid == 1:
+            age(mailbox, shard.claims, agent.CLAIM_TIMEOUT_SEC + 1)
+            assert other.claim(mailbox, [2]) == [2]
+
+    pipeline = FakePipeline(2, on_submit=stall)
+    run_cycle(monkeypatch, mailbox, shard, pipeline)
+    assert pipeline.submitted == [1]
+    assert 2 not in shard.claims.held and not shard.checkpoint.is_pending(2)
@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def record(message_id, sender, references=None):
+    return agent.EmailRecord(uid=1, sender=sender, subject="s", message_id=message_id,
+                             prompt="", references=references)
+
+
+def test_followup_continues_thread(tmp_path):
+    store = agent.ConversationStore(str(tmp_path / "c.sqlite3"))
+    store.add_turn("<q1@x>", "<q1@x>", "user", "Ile kosztuje?", "agent@x", "jan@x")
+    store.add_turn("<q1@x>", "<r1@agent>", "model", "100 zł", "agent@x", "jan@x")
+    followup = record("<q2@x>", "Jan@X", references="<q1@x> <r1@agent>")
+    thread_id = store.thread_for(followup, "agent@x")
+    assert thread_id == "<q1@x>"
+    assert store.history(thread_id, "<q2@x>", "agent@x", "jan@x") == [
+        {"role": "user", "parts": ["Ile kosztuje?"]},
+        {"role": "model", "parts": ["100 zł"]},
+    ]
+
+
+def test_other_sender_does_not_see_history(tmp_path):
+    store = agent.ConversationStore(str(tmp_path / "c.sqlite3"))
+    store.add_turn("<q1@x>", "<q1@x>", "user", "Mój PESEL to ...", "agent@x", "jan@x")
+    store.add_turn("<q1@x>", "<r1@agent>", "model", "Dziękuję", "agent@x", "jan@x")
+    forwarded = record("<q9@y>", "obcy@y", references="<q1@x> <r1@agent>")
+    assert store.thread_for(forwarded, "agent@x") == "<q9@y>"
+    assert store.history("<q1@x>", "<q9@y>", "agent@x", "obcy@y") == []
+
+
+def test_accounts_are_separate(tmp_path):
+    store = agent.ConversationStore(str(tmp_path / "c.sqlite3"))
+    store.add_turn("<q1@x>", "<q1@x>", "user", "Pytanie", "sales@x", "jan@x")
+    store.add_turn("<q1@x>", "<q1@x>", "user", "Pytanie", "support@x", "jan@x")
+    assert store.history("<q1@x>", "<q2@x>", "sales@x", "jan@x") == [{"role": "user", "parts": ["Pytanie"]}]
+    assert store.thread_for(record("<q2@x>", "jan@x", references="<q1@x>"), "billing@x") == "<q2@x>"
@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def literal(head, payload):
+    return (head.encode(), payload)
+
+
+def test_parse_fetch_response_multiple_messages():
+    data = [
+        literal('1 (UID 10 RFC822.SIZE 120 BODY[HEADER.FIELDS (FROM)] {13}', b"From: a@x\r\n\r\n"),
+        b' FLAGS (\\Seen $Answered))',
+        b'2 (UID 11 RFC822.SIZE 7 FLAGS () BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL))',
+    ]
+    messages = agent.parse_fetch_response(data)
+    assert set(messages) == {10, 11}
+    assert messages[10]["BODY[HEADER.FIELDS (FROM)]"] == b"From: a@x\r\n\r\n"
+    assert messages[10]["FLAGS"] == ["\\Seen", "$Answered"]
+    assert messages[11]["RFC822.SIZE"] == "7"
+    assert messages[11]["FLAGS"] == []
+    assert messages[11]["BODYSTRUCTURE"][:2] == ["TEXT", "PLAIN"]
+
+
+def test_parse_fetch_response_quoted_strings_and_nil():
+    data = [b'1 (UID 5 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL "a \\"b\\"" "BASE64" 4 1 NIL NIL NIL NIL))']
+    structure = agent.parse_fetch_response(data)[5]["BODYSTRUCTURE"]
+    assert structure[2] == ["CHARSET", "utf-8"]
+    assert structure[3] is None
+    assert structure[4] == 'a "b"'
+
+
+TEXT_PLAIN = ["TEXT", "PLAIN", ["CHARSET", "iso-8859-2"], None, None, "QUOTED-PRINTABLE", "10", "1", None, None, None, None]
+TEXT_HTML = ["TEXT", "HTML", ["CHARSET", "utf-8"], None, None, "BASE64", "10", "1", None, None, None, None]
+PDF = ["APPLICATION", "PDF", ["NAME", "f.pdf"], None, None, "BASE64", "999", None, ["ATTACHMENT", ["FILENAME", "f.pdf"]], None, None]
+
+
+def test_find_text_section_single_part():
+    assert agent.find_text_section(TEXT_PLAIN) == ("1", "QUOTED-PRINTABLE", "iso-8859-2")
+
+
+def test_find_text_section_nested_multipart():
+    alternative = [TEXT_PLAIN, TEXT_HTML, "ALTERNATIVE"]
+    structure = [alternative, PDF, "MIXED"]
+    assert agent.find_text_section(structure) == ("1.1", "QUOTED-PRINTABLE", "iso-8859-2")
+    assert agent.find_text_section(structure, subtype="html") == ("1.2", "BASE64", "utf-8")
+
+
+def test_find_text_section_skips_text_attachment():
+    attached = TEXT_PLAIN[:9] + [["ATTACHMENT", ["FILENAME", "notes.txt"]]] + TEXT_PLAIN[10:]
+    assert agent.find_text_section([attached, PDF, "MIXED"]) is None
+
+
+def test_find_text_section_rejects_unusual_structure():
+    rfc822 = ["MESSAGE", "RFC822", None, None, None, "7BIT", "100", [], [], "5"]
+    for structure in ([], ["TEXT", "PLAIN"], [rfc822, "MIXED"]):
+        try:
+            agent.find_text_section(structure)
+        except ValueError:
+            continue
+        raise AssertionError(f"brak ValueError dla {structure!r}")
+
+
+def test_decode_section_encodings():
+    assert agent.decode_section(b"Zm9v\r\nYmFy", "BASE64", None) == "foobar"
+    assert agent.decode_section(b"=BF=F3=B3w", "QUOTED-PRINTABLE", "iso-8859-2") == "żółw"
+    assert agent.decode_section(b"abc", "7BIT", "no-such-charset") == "abc"
+
+
+def test_run_parsers_reports_bad_padding_as_none():
+    results = agent.run_parsers({
+        1: (agent.decode_section, b"YWJj\r\nZA", "BASE64", "utf-8"),
+        2: (agent.decode_section, b"YWJj", "BASE64", None),
+    })
+    assert results == {1: None, 2: "abc"}
@@ -0,0 +1,111 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+class Clock:
+    """Sztuczny zegar dla time.monotonic / time.sleep."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(agent.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(agent.time, "sleep", clock.sleep)
+    return clock
+
+
+class FakeModel:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.timeouts = []
+
+    def generate_content(self, prompt, request_options):
+        self.timeouts.append(request_options["timeout"])
+        if self.errors:
+            raise self.errors.pop(0)
+        return FakeResponse()
+
+
+class FakeResponse:
+    text = "odpowiedź"
+    parts = ["odpowiedź"]
+    usage_metadata = None
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(agent.gemini_client, "model", lambda *args, **kwargs: model)
+    monkeypatch.setattr(agent, "GEMINI_STREAMING", False)
+    monkeypatch.setattr(agent, "gemini_breaker", agent.CircuitBreaker(threshold=2, reset_after=60))
+    monkeypatch.setattr(agent, "rate_limiter", agent.RateLimiter({agent.GEMINI_MODEL: (2, 100_000)}))
+    return model
+
+
+def test_token_bucket_queues_instead_of_exceeding(clock):
+    bucket = agent.TokenBucket(60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(30) == pytest.approx(30)
+    clock.sleep(30)
+    assert bucket.available() == 0
+    bucket.adjust(-30)
+    assert bucket.available() == 30
+
+
+def test_rate_limiter_refunds_and_defers(clock):
+    limiter = agent.RateLimiter({"m": (1, 1000)})
+    limiter.acquire("m", 400)
+    assert limiter.headroom("m") == (0, 600)
+    limiter.release("m", 400, request=False)
+    assert limiter.headroom("m") == (0, 1000)
+    with pytest.raises(agent.GeminiUnavailable):
+        limiter.acquire("m", 100, deadline=clock.now + 30)
+    assert clock.now == 1000.0
+    assert limiter.headroom("m") == (0, 1000)
+
+
+def test_circuit_breaker_opens_and_probes(clock):
+    breaker = agent.CircuitBreaker(threshold=2, reset_after=60)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.is_open() and not breaker.allow_request()
+    clock.sleep(61)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # tylko jedno zapytanie próbne
+    breaker.abandon_probe()
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert not breaker.is_open() and breaker.failures == 0
+
+
+def test_long_limiter_queue_defers_without_tripping_breaker(clock, gemini, monkeypatch):
+    monkeypatch.setattr(agent, "GEMINI_DEADLINE_SEC", 30)
+    agent.rate_limiter.acquire(agent.GEMINI_MODEL, 0)
+    agent.rate_limiter.acquire(agent.GEMINI_MODEL, 0)
+    with pytest.raises(agent.GeminiUnavailable):
+        agent.get_gemini_response("pytanie")
+    assert gemini.timeouts == []
+    assert agent.gemini_breaker.failures == 0
+
+
+def test_retryable_error_is_retried_and_tokens_refunded(clock, gemini, monkeypatch):
+    monkeypatch.setattr(agent.random, "uniform", lambda low, high: 0.0)
+    gemini.errors = [ConnectionError("reset")]
+    assert agent.get_gemini_response("pytanie") == "odpowiedź"
+    assert len(gemini.timeouts) == 2
+    assert agent.gemini_breaker.failures == 0
+    estimated = agent.estimate_tokens("pytanie")
+    assert agent.rate_limiter.headroom(agent.GEMINI_MODEL)[1] == 100_000 - estimated
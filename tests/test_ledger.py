@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+class Session:
+    """Sesja IMAP, która nigdy się nie łączy - rejestr potrzebuje tylko konta sharda."""
+
+
+@pytest.fixture
+def sales_shard(tmp_path, monkeypatch):
+    account = agent.Account("sales", "sales@example.com", "p", outbox=object())
+    shard = agent.Shard(account, "INBOX", Session(), agent.SyncCheckpoint(str(tmp_path / "sales.json")))
+    monkeypatch.setitem(agent.shards, shard.name, shard)
+    return shard
+
+
+def record(message_id="<q1@x>", prompt="Ile kosztuje?", shard="", uid=1):
+    return agent.EmailRecord(uid=uid, sender="jan@x", subject="Cena", message_id=message_id,
+                             prompt=prompt, shard=shard)
+
+
+def make_ledger(tmp_path):
+    return agent.ProcessedLedger(str(tmp_path / "ledger.sqlite3"), capacity=1000)
+
+
+def test_states_only_move_forward(tmp_path):
+    ledger = make_ledger(tmp_path)
+    mail = record()
+    assert ledger.lookup(mail) == (None, None)
+    ledger.mark(mail, "generated", "100 zł")
+    assert ledger.lookup(mail) == ("generated", "100 zł")
+    ledger.mark(mail, "fetched")
+    assert ledger.lookup(mail)[0] == "generated"
+    ledger.mark(mail, "sent")
+    ledger.mark_flagged([1])
+    assert make_ledger(tmp_path).lookup(mail) == ("flagged", None)
+
+
+def test_same_mail_to_two_accounts_is_answered_twice(tmp_path, sales_shard):
+    ledger = make_ledger(tmp_path)
+    ledger.mark(record(), "sent")
+    assert ledger.lookup(record(shard=sales_shard.name)) == (None, None)
+
+
+def test_reused_message_id_with_other_content_is_new(tmp_path):
+    ledger = make_ledger(tmp_path)
+    ledger.mark(record(), "sent")
+    other = record(prompt="Zupełnie inne pytanie", uid=2)
+    assert ledger.lookup(other) == (None, None)
+    ledger.mark(other, "generated", "odpowiedź")
+    assert ledger.lookup(other) == ("generated", "odpowiedź")
+    assert ledger.lookup(record())[0] == "sent"
@@ -0,0 +1,115 @@
+import smtplib
+from email.message import EmailMessage
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+class FakeSmtp:
+    """Serwer SMTP w pamięci; wybrane adresy odrzuca albo zrywa połączenie."""
+
+    def __init__(self, refused=(), rejected=(), disconnect=()):
+        self.refused, self.rejected, self.disconnect = set(refused), set(rejected), set(disconnect)
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, from_addr, to_addrs, raw):
+        to_addr = to_addrs[0]
+        if to_addr in self.refused:
+            raise smtplib.SMTPRecipientsRefused({to_addr: (550, b"no such user")})
+        if to_addr in self.rejected:
+            raise smtplib.SMTPDataError(554, b"rejected")
+        if to_addr in self.disconnect:
+            raise smtplib.SMTPServerDisconnected("connection lost")
+        self.sent.append(to_addr)
+
+    def noop(self):
+        return 250, b"OK"
+
+    def quit(self):
+        self.closed = True
+
+
+class FakePool(agent.SmtpPool):
+    def __init__(self, **behaviour):
+        super().__init__(size=1)
+        self.behaviour = behaviour
+        self.opened = []
+
+    def _open(self):
+        smtp = FakeSmtp(**self.behaviour)
+        self.opened.append(smtp)
+        return agent._PooledSmtp(smtp)
+
+
+def make_outbox(tmp_path, **behaviour):
+    return agent.Outbox(str(tmp_path / "outbox.sqlite3"), FakePool(**behaviour))
+
+
+def message(to_addr):
+    msg = EmailMessage()
+    msg["From"] = "agent@example.com"
+    msg["To"] = to_addr
+    msg["Subject"] = "Re: test"
+    msg.set_content("odpowiedź")
+    return msg
+
+
+def queue_due(outbox, *addresses):
+    for address in addresses:
+        outbox.put(message(address))
+    outbox._db.execute("UPDATE outbox SET next_attempt = 0")
+
+
+def rows(outbox):
+    return outbox._db.execute("SELECT to_addr, status, attempts FROM outbox ORDER BY id").fetchall()
+
+
+def test_send_now_delivers_and_removes_row(tmp_path):
+    outbox = make_outbox(tmp_path)
+    msg = message("a@example.com")
+    outbox.send_now(outbox.put(msg), msg)
+    assert outbox.pool.opened[0].sent == ["a@example.com"]
+    assert rows(outbox) == []
+
+
+def test_flush_marks_rejected_rows_only(tmp_path):
+    outbox = make_outbox(tmp_path, refused={"bad@example.com"}, rejected={"spam@example.com"})
+    queue_due(outbox, "a@example.com", "bad@example.com", "b@example.com", "spam@example.com", "c@example.com")
+    outbox.flush()
+    assert len(outbox.pool.opened) == 1
+    assert outbox.pool.opened[0].sent == ["a@example.com", "b@example.com", "c@example.com"]
+    assert rows(outbox) == [("bad@example.com", "dead", 1), ("spam@example.com", "dead", 1)]
+
+
+def test_flush_reschedules_rest_of_batch_after_disconnect(tmp_path):
+    outbox = make_outbox(tmp_path, disconnect={"b@example.com"})
+    queue_due(outbox, "a@example.com", "b@example.com", "c@example.com")
+    outbox.flush()
+    assert outbox.pool.opened[0].sent == ["a@example.com"]
+    assert rows(outbox) == [("b@example.com", "pending", 1), ("c@example.com", "pending", 1)]
+
+
+def test_pool_does_not_retry_permanent_errors(tmp_path):
+    pool = FakePool(refused={"bad@example.com"})
+    try:
+        pool.send("agent@example.com", ["bad@example.com"], b"x")
+    except smtplib.SMTPRecipientsRefused:
+        pass
+    else:
+        raise AssertionError("oczekiwano SMTPRecipientsRefused")
+    pool.send("agent@example.com", ["a@example.com"], b"x")
+    assert len(pool.opened) == 1 and not pool.opened[0].closed
+
+
+def test_pool_retries_once_after_disconnect():
+    pool = FakePool(disconnect={"a@example.com"})
+    try:
+        pool.send("agent@example.com", ["a@example.com"], b"x")
+    except smtplib.SMTPServerDisconnected:
+        pass
+    assert len(pool.opened) == 2
+    assert all(smtp.closed for smtp in pool.opened)
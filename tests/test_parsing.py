@@ -0,0 +1,63 @@
+from email.message import EmailMessage
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def make_message(text=None, html=None, attachment=None):
+    msg = EmailMessage()
+    msg["From"] = "Jan <jan@example.com>"
+    msg["Subject"] = "Pytanie"
+    msg["Message-ID"] = "<q1@example.com>"
+    if text is not None:
+        msg.set_content(text)
+    if html is not None:
+        if text is None:
+            msg.set_content(html, subtype="html")
+        else:
+            msg.add_alternative(html, subtype="html")
+    if attachment is not None:
+        msg.add_attachment(attachment, maintype="application", subtype="pdf", filename="f.pdf")
+    return msg.as_bytes()
+
+
+def test_parse_message_bytes_plain_with_attachment():
+    raw = make_message(text="Ile to kosztuje?\n", attachment=b"\0" * 200_000)
+    record = agent.parse_message_bytes(raw, 7)
+    assert record.uid == 7
+    assert record.sender == "jan@example.com"
+    assert record.message_id == "<q1@example.com>"
+    assert record.prompt.strip() == "Ile to kosztuje?"
+
+
+def test_parse_message_bytes_prefers_plain_over_html():
+    raw = make_message(text="zwykły tekst\n", html="<p>wersja <b>HTML</b></p>")
+    assert agent.parse_message_bytes(raw, 1).prompt.strip() == "zwykły tekst"
+
+
+def test_parse_message_bytes_falls_back_to_html():
+    raw = make_message(html="<html><body><p>Czy możesz <b>pomóc</b>?</p><script>x()</script></body></html>")
+    assert agent.parse_message_bytes(raw, 1).prompt.strip() == "Czy możesz pomóc?"
+
+
+def test_streaming_extractor_matches_in_small_chunks():
+    raw = make_message(text="Treść w wielu kawałkach\n", attachment=b"x" * 5000)
+    extractor = agent.StreamingTextExtractor()
+    for i in range(0, len(raw), 7):
+        extractor.feed(raw[i:i + 7])
+        if extractor.done:
+            break
+    extractor.close()
+    assert extractor.record(3).prompt.strip() == "Treść w wielu kawałkach"
+
+
+def test_html_to_text_drops_markup_and_keeps_structure():
+    text = agent.html_to_text("<h1>Tytuł</h1><p>Akapit&nbsp;pierwszy</p><ul><li>jeden</li><li>dwa</li></ul>")
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    assert lines[0] == "Tytuł"
+    assert "Akapit pierwszy" in lines
+    assert any(line.endswith("jeden") for line in lines)
+    assert any(line.endswith("dwa") for line in lines)
@@ -0,0 +1,45 @@
+import queue
+import sqlite3
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def record(uid=1):
+    return agent.EmailRecord(uid=uid, sender="jan@x", subject="s", message_id=f"<q{uid}@x>", prompt="Pytanie?")
+
+
+def broken_generate(record):
+    raise sqlite3.OperationalError("database is locked")
+
+
+def test_process_email_reports_unexpected_error_as_failure(monkeypatch):
+    monkeypatch.setattr(agent, "generate_answer", broken_generate)
+    assert agent.process_email(record()) is False
+
+
+def test_process_email_defers_when_gemini_is_unavailable(monkeypatch):
+    def unavailable(record):
+        raise agent.GeminiUnavailable("bezpiecznik")
+    monkeypatch.setattr(agent, "generate_answer", unavailable)
+    assert agent.process_email(record()) is None
+
+
+def test_pipeline_worker_error_is_not_committed(monkeypatch):
+    monkeypatch.setattr(agent, "generate_answer", broken_generate)
+    pipeline = agent.Pipeline(workers=1, queue_size=2)
+    done = queue.Queue()
+    pipeline.submit(record(7), done)
+    assert done.get(timeout=5) == (7, False)
+
+
+def test_pipeline_capacity_is_per_mailbox():
+    pipeline = agent.Pipeline(workers=0, queue_size=2)
+    queued = record(1)
+    queued.shard = "inbox"
+    pipeline.submit(queued, queue.Queue())
+    assert pipeline.capacity("inbox") == 1
+    assert pipeline.capacity("sales") == 2
@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+def test_strips_trailing_reply_quote():
+    text = "Dziękuję, a ile to kosztuje?\n\nOn Mon, 1 Jan 2024 at 10:00, Jan <jan@x.pl> wrote:\n> Cena zależy\n> od wersji.\n"
+    assert agent.strip_quoted_text(text) == "Dziękuję, a ile to kosztuje?"
+
+
+def test_strips_gmail_header_split_over_two_lines():
+    text = "Nowe pytanie.\n\nW dniu 1.01.2024 o 10:00 Jan Kowalski <jan@x.pl>\nnapisał:\n> stary tekst\n"
+    assert agent.strip_quoted_text(text) == "Nowe pytanie."
+
+
+def test_strips_outlook_header_block():
+    text = "Proszę o fakturę.\n\nFrom: Jan <jan@x.pl>\nSent: Monday\nTo: agent\nSubject: x\n\nStara treść\n"
+    assert agent.strip_quoted_text(text) == "Proszę o fakturę."
+
+
+def test_keeps_reply_header_inside_content():
+    text = "On Monday my boss wrote:\nthe deadline moves to Friday.\nCan you summarise what this means for us?"
+    assert agent.strip_quoted_text(text) == text
+
+
+def test_keeps_inline_quotes():
+    text = "> Czy da się to zrobić?\nTak, ale proszę doprecyzować:\n> w jakim terminie?\nDo piątku."
+    assert agent.strip_quoted_text(text) == text
+
+
+def test_keeps_content_after_bare_dashes():
+    body = "\n".join(f"Punkt {i}" for i in range(1, 12))
+    text = f"Lista zmian:\n--\n{body}"
+    assert agent.strip_quoted_text(text) == text
+
+
+def test_strips_signature_and_footer():
+    text = "Proszę o ofertę.\n\n-- \nJan Kowalski\ntel. 123\n\nSent from my iPhone"
+    assert agent.strip_quoted_text(text) == "Proszę o ofertę."
+
+
+def test_quote_only_mail_is_left_alone():
+    text = "> tylko cytat\n> nic więcej"
+    assert agent.strip_quoted_text(text) == text
+
+
+def test_strips_mobile_footer_without_blank_line():
+    assert agent.strip_quoted_text("Proszę o odpowiedź.\nWysłane z mojego iPhone'a") == "Proszę o odpowiedź."
+
+
+def test_strips_legal_notice_paragraph_at_the_end():
+    text = ("Czy zamówienie wyszło?\n\nJan\n\nThis e-mail is confidential and may contain privileged\n"
+            "information. If you are not the intended recipient, delete it.\n\nSent from my iPhone")
+    assert agent.strip_quoted_text(text) == "Czy zamówienie wyszło?\n\nJan"
+
+
+@pytest.mark.parametrize("text", [
+    "Dzień dobry,\nWysłane z opóźnieniem zestawienie jest w załączniku.\nCzy możesz je podsumować w trzech punktach?",
+    "Hi,\nThis message is intended for the finance team only, please summarise:\nRevenue grew 5% in Q3.",
+    "Witam,\nDISCLAIMER text on our site says X.\nIs it legally OK?",
+    "This e-mail is confidential.\n\nWhat are our options?",
+])
+def test_keeps_sentences_that_look_like_footers(text):
+    assert agent.strip_quoted_text(text) == text
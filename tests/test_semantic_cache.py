@@ -0,0 +1,92 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("google.generativeai")
+
+import agent  # noqa: E402
+
+
+class StubEmbedder:
+    """Deterministyczna atrapa: każdy znany prompt ma zadany wektor."""
+
+    dim = 3
+
+    def __init__(self, vectors):
+        self.vectors = {key: np.asarray(value, dtype=np.float32) for key, value in vectors.items()}
+
+    def __call__(self, texts):
+        rows = [self.vectors[text] for text in texts]
+        return np.stack([row / np.linalg.norm(row) for row in rows])
+
+
+VECTORS = {
+    "jaka jest stolica australii?": [1.0, 0.0, 0.0],
+    "podaj stolicę australii": [0.99, 0.1, 0.0],
+    "jaka jest stolica austrii?": [0.0, 1.0, 0.0],
+    "przetłumacz na niemiecki": [0.0, 0.0, 1.0],
+}
+
+
+def make_cache(tmp_path, **kwargs):
+    return agent.SemanticCache(str(tmp_path), StubEmbedder(VECTORS), capacity=2, threshold=0.92, **kwargs)
+
+
+def test_similar_prompt_hits(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    answer, similarity = cache.lookup("Podaj stolicę   Australii", "gemini")
+    assert answer == "Canberra"
+    assert similarity > 0.99
+
+
+def test_different_meaning_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    assert cache.lookup("Jaka jest stolica Austrii?", "gemini") == (None, 0.0)
+
+
+def test_namespaces_are_separate(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    assert cache.lookup("Jaka jest stolica Australii?", "inny-model")[0] is None
+
+
+def test_expired_entries_are_ignored(tmp_path):
+    cache = make_cache(tmp_path, ttl=-1)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    assert cache.lookup("Jaka jest stolica Australii?", "gemini")[0] is None
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    cache.put("Jaka jest stolica Austrii?", "gemini", "Wiedeń")
+    cache.lookup("Jaka jest stolica Australii?", "gemini")
+    cache.put("Przetłumacz na niemiecki", "gemini", "Übersetze")
+    assert cache.lookup("Jaka jest stolica Australii?", "gemini")[0] == "Canberra"
+    assert cache.lookup("Jaka jest stolica Austrii?", "gemini")[0] is None
+
+
+def test_index_survives_restart(tmp_path):
+    make_cache(tmp_path).put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    assert make_cache(tmp_path).lookup("Podaj stolicę Australii", "gemini")[0] == "Canberra"
+
+
+def test_semantic_tier_requires_model(monkeypatch):
+    monkeypatch.setattr(agent, "SEMANTIC_CACHE_MODEL", "")
+    assert agent._create_semantic_cache() is None
+
+
+def test_crash_while_overwriting_slot_drops_old_answer(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    cache.put("Jaka jest stolica Australii?", "gemini", "Canberra")
+    cache.put("Jaka jest stolica Austrii?", "gemini", "Wiedeń")
+
+    def crash():
+        raise OSError("awaria w trakcie zapisu")
+
+    # Nowy wektor trafia do slotu "Canberry", wiersz SQLite nie zostaje już zapisany
+    monkeypatch.setattr(cache._vectors, "flush", crash)
+    with pytest.raises(OSError):
+        cache.put("Przetłumacz na niemiecki", "gemini", "Übersetze")
+    assert make_cache(tmp_path).lookup("Przetłumacz na niemiecki", "gemini")[0] is None